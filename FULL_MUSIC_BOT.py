@@ -4,46 +4,76 @@
 Включает: поиск музыки, скачивание, базу данных, админ панель, премиум функции
 """
 
+import time
+_process_started = time.perf_counter()
+
 import asyncio
+import bisect
+import contextlib
+import glob
 import logging
+import math
 import os
 import signal
+import subprocess
 import sys
 import threading
-import time
+import hashlib
 import json
+import random
+import re
+import shutil
 import tempfile
-import yt_dlp
+import traceback
+import zlib
 import aiofiles
 import asyncpg
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import Optional, List, Dict, Any
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from typing import Optional, List, Dict, Any, Callable, Awaitable
+_core_imported = time.perf_counter()
 from aiogram.webhook.aiohttp_server import setup_application
 
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, ExceptionTypeFilter
+from aiogram.types import Message, CallbackQuery, InlineQuery, TelegramObject, Update, ErrorEvent, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, FSInputFile, BufferedInputFile
+from aiogram.types import InlineQueryResultArticle, InlineQueryResultCachedAudio, InputTextMessageContent
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+_aiogram_imported = time.perf_counter()
 
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
 ADMIN_ID = 1979411532
+# Собственный Bot API сервер (telegram-bot-api --local): загрузка по локальному пути, лимит 2000 MB
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Локальный режим возможен только со своим сервером: без TELEGRAM_API_URL флаг игнорируется
+TELEGRAM_API_LOCAL = bool(TELEGRAM_API_URL) and os.getenv('TELEGRAM_API_LOCAL', '1') == '1'
 
 if not BOT_TOKEN:
     print("BOT_TOKEN not found")
     sys.exit(1)
 
+if os.getenv('TELEGRAM_API_LOCAL') == '1' and not TELEGRAM_API_URL:
+    print("⚠️ TELEGRAM_API_LOCAL=1 без TELEGRAM_API_URL игнорируется: файлы уходят на api.telegram.org, лимит 50 MB")
+
 # Инициализация
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL))
+    )
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 start_time = datetime.now()
 
 # Глобальные переменные
-user_search_results = {}
 user_languages = {}
 user_stats = {'messages': 0, 'users': set(), 'downloads': 0}
 
@@ -51,6 +81,149 @@ user_stats = {'messages': 0, 'users': set(), 'downloads': 0}
 FREE_DAILY_LIMIT = 5
 PREMIUM_DAILY_LIMIT = 100
 
+# Профилирование
+SLOW_HANDLER_THRESHOLD = float(os.getenv('SLOW_HANDLER_THRESHOLD', '2.0'))
+SLOW_QUERY_THRESHOLD = float(os.getenv('SLOW_QUERY_THRESHOLD', '0.5'))
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.005
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.1'))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.5'))
+
+# Очередь обновлений webhook
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+UPDATE_PER_USER_LIMIT = int(os.getenv('UPDATE_PER_USER_LIMIT', '20'))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv('UPDATE_ENQUEUE_TIMEOUT', '2.0'))
+
+# Многопроцессный режим
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '1'))
+WORKER_INDEX = 0
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'music_bot_metrics'))
+METRICS_FLUSH_INTERVAL = 5
+METRICS_STALE_AFTER = 60
+SEARCH_RESULTS_TTL = 3600
+
+# Агрегаты аналитики: верхние границы корзин задержки доставки в секундах
+LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 20, 30, 60, 120]
+ROLLUP_FLUSH_INTERVAL = 30
+
+# Чарты: ёмкость Space-Saving на срез, вес скачивания относительно поиска, период чекпоинта
+CHARTS_CAPACITY = int(os.getenv('CHARTS_CAPACITY', '100'))
+CHARTS_DOWNLOAD_WEIGHT = 3
+CHARTS_CHECKPOINT_INTERVAL = int(os.getenv('CHARTS_CHECKPOINT_INTERVAL', '60'))
+
+# Экспорт: размер сжатой части, после которого она отправляется документом, и предел на весь COPY
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_MB', '20')) * 1024 * 1024
+EXPORT_TIMEOUT = float(os.getenv('EXPORT_TIMEOUT', '3600'))
+
+# Размер страницы /user_list
+USER_LIST_PAGE_SIZE = 20
+
+# Партиции downloads: запас будущих месяцев, срок хранения сырых строк, судьба старых партиций (archive/drop)
+DOWNLOADS_PARTITIONS_AHEAD = 3
+DOWNLOADS_RETENTION_MONTHS = int(os.getenv('DOWNLOADS_RETENTION_MONTHS', '12'))
+DOWNLOADS_ARCHIVE_MODE = os.getenv('DOWNLOADS_ARCHIVE_MODE', 'archive')
+ROLLUP_HOURLY_RETENTION_DAYS = 30
+PARTITION_MAINTENANCE_INTERVAL = 6 * 3600
+
+# Моя музыка / Избранное: вид -> (таблица, колонка времени, заголовок, текст пустого списка)
+LIBRARY_PAGE_SIZE = 10
+LIBRARY_VIEWS = {
+    'h': ('downloads', 'downloaded_at', "🎵 МОЯ МУЗЫКА", "Здесь появятся скачанные треки."),
+    'f': ('favorites', 'added_at', "❤️ ИЗБРАННОЕ", "Добавляйте треки в избранное кнопкой 🤍 в результатах поиска!"),
+}
+
+# Поиск: источники yt-dlp с дедлайнами в секундах
+SEARCH_SOURCES = os.getenv('SEARCH_SOURCES', 'ytsearch:6,scsearch:4')
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))
+SEARCH_SOURCE_MAX_FAILURES = 3
+SEARCH_SOURCE_COOLDOWN = 60
+
+# Скачивание и предзагрузка (PREFETCH_MODE: off | resolve | download)
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+
+# База: бюджет соединений на узел делится между процессами-воркерами (max_connections у Postgres общий),
+# внутри процесса пул прогревается под число обработчиков апдейтов; автомат и журнал записей на время отказа
+DB_NODE_POOL_MIN = int(os.getenv('DB_NODE_POOL_MIN', str(min(UPDATE_WORKERS, 8))))
+DB_NODE_POOL_MAX = int(os.getenv('DB_NODE_POOL_MAX', str(max(UPDATE_WORKERS + 4, 10))))
+DB_POOL_MAX = max(2, DB_NODE_POOL_MAX // max(WEB_WORKERS, 1))
+DB_POOL_MIN = min(DB_POOL_MAX, max(1, DB_NODE_POOL_MIN // max(WEB_WORKERS, 1)))
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '5'))
+DB_BREAKER_THRESHOLD = 3
+DB_BREAKER_COOLDOWN = float(os.getenv('DB_BREAKER_COOLDOWN', '15'))
+DB_HEALTH_INTERVAL = 10
+DB_JOURNAL_LIMIT = 10000
+# Допуск к тяжёлой работе: (запросов в минуту, запас) на пользователя по тарифу и (в секунду, запас) на узел
+ADMISSION_USER_LIMITS = {
+    ('search', False): (10, 5),
+    ('search', True): (30, 10),
+    ('download', False): (6, 3),
+    ('download', True): (20, 6),
+}
+ADMISSION_GLOBAL_LIMITS = {
+    'search': (float(os.getenv('ADMISSION_SEARCH_RATE', '5')), 20),
+    'download': (float(os.getenv('ADMISSION_DOWNLOAD_RATE', '2')), 10),
+}
+# Дренаж при остановке: сколько ждать текущую работу и сколько живут сохранённые для следующего инстанса обновления
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '25'))
+PENDING_UPDATES_MAX_AGE = 3600
+PENDING_UPDATES_POLL_INTERVAL = 5
+PENDING_UPDATES_POLL_WINDOW = 600
+
+ADMISSION_PREMIUM_TTL = 300
+ADMISSION_NOTICE_INTERVAL = 10
+
+# Версия схемы: увеличивать при каждом изменении create_tables
+SCHEMA_VERSION = 2
+SCHEMA_LOCK_ID = 0x6D757369
+PREFETCH_MODE = os.getenv('PREFETCH_MODE', 'resolve')
+PREFETCH_TTL = 300
+PREFETCH_MAX_DURATION = 900
+PREFETCH_NICE = 10
+PREFETCH_MAX_SESSIONS = int(os.getenv('PREFETCH_MAX_SESSIONS', '3'))
+
+# Движок загрузок: фрагменты, повторы, общий бюджет сети (0 — без ограничения)
+DOWNLOAD_FRAGMENTS = int(os.getenv('DOWNLOAD_FRAGMENTS', '4'))
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_BACKOFF = 2.0
+NODE_BANDWIDTH_MBIT = float(os.getenv('NODE_BANDWIDTH_MBIT', '0'))
+
+# Локальный индекс доставленных треков
+LOCAL_INDEX_REFRESH_INTERVAL = 60
+
+# Качество аудио: все варианты кодируются за один проход ffmpeg
+AUDIO_BITRATES = sorted({int(bitrate) for bitrate in os.getenv('AUDIO_BITRATES', '192,320').split(',')})
+FREE_BITRATE = AUDIO_BITRATES[0]
+PREMIUM_BITRATE = AUDIO_BITRATES[-1]
+VARIANTS_TTL = 1800
+
+# Рабочие каталоги задач и уборщик
+JOB_MAX_AGE = 3 * 3600
+JANITOR_INTERVAL = 60
+VARIANTS_DISK_QUOTA = int(os.getenv('VARIANTS_DISK_QUOTA_MB', '2048')) * 1024 * 1024
+
+# Лимиты Telegram: размер прогнозируется по длительности до скачивания
+UPLOAD_LIMIT = (1999 if TELEGRAM_API_LOCAL else 49) * 1024 * 1024
+FALLBACK_BITRATES = (160, 128)
+MAX_TRACK_DURATION = 4 * 3600
+MAX_SOURCE_SIZE = 1024 * 1024 * 1024
+MAX_PARTS = 10
+MP3_SIZE_OVERHEAD = 1.02
+MP3_SIZE_RESERVE = 64 * 1024
+
+# Кэши и inline режим
+AUDIO_CACHE_MEMORY = 5000
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 1800
+INLINE_RESULTS = 10
+INLINE_DEBOUNCE = float(os.getenv('INLINE_DEBOUNCE', '0.4'))
+INLINE_DEADLINE = float(os.getenv('INLINE_DEADLINE', '2.5'))
+INLINE_CACHE_TIME = 300
+
+# Плейлисты и альбомы
+PLAYLIST_MAX_TRACKS = 50
+PLAYLIST_PARALLEL_PER_USER = int(os.getenv('PLAYLIST_PARALLEL_PER_USER', '2'))
+
 # HTTP сервер для поддержания активности
 class KeepAliveHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -61,12 +234,13 @@ class KeepAliveHandler(BaseHTTPRequestHandler):
             self.end_headers()
             
             uptime_str = str(datetime.now() - start_time)
+            metrics = aggregate_metrics()
             response = {
                 "status": "full_music_bot_active",
                 "uptime": uptime_str,
-                "messages": user_stats["messages"],
-                "users": len(user_stats["users"]),
-                "downloads": user_stats["downloads"],
+                "messages": metrics["messages"],
+                "users": len(metrics["users"]),
+                "downloads": metrics["downloads"],
                 "timestamp": datetime.now().isoformat(),
                 "mode": "full_functional_bot"
             }
@@ -90,28 +264,578 @@ def start_http_server():
         except Exception as e:
             print(f"HTTP server error: {e}")
     threading.Thread(target=run, daemon=True).start()
-    time.sleep(2)
+
+# Профиль холодного старта: импорты, схема, вебхук, готовность приложения
+class StartupProfile:
+    def __init__(self):
+        self.phases: List[tuple] = [
+            ("импорт stdlib/asyncpg", _core_imported - _process_started),
+            ("импорт aiogram", _aiogram_imported - _core_imported),
+        ]
+        self.started = _process_started
+
+    def record(self, name: str, seconds: float):
+        self.phases.append((name, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self) -> str:
+        lines = [f"• {name}: {seconds * 1000:.0f}ms" for name, seconds in self.phases]
+        return "\n".join(lines)
+
+startup = StartupProfile()
+
+# yt-dlp импортируется при первом поиске или скачивании, а не при старте процесса
+_yt_dlp_module = None
+_yt_dlp_lock = threading.Lock()
+
+def load_yt_dlp():
+    global _yt_dlp_module
+    if _yt_dlp_module is None:
+        with _yt_dlp_lock:
+            if _yt_dlp_module is None:
+                with startup.phase("импорт yt_dlp (отложенный)"):
+                    import yt_dlp
+                _yt_dlp_module = yt_dlp
+    return _yt_dlp_module
+
+# Метрики времени выполнения
+def _percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+class TimingStats:
+    """Время выполнения по ключам: хендлеры, кнопки, SQL запросы"""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+        self.counts: Counter = Counter()
+        self.totals: Dict[str, float] = {}
+        self.maximums: Dict[str, float] = {}
+
+    def record(self, key: str, elapsed: float):
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+            self.totals[key] = 0.0
+            self.maximums[key] = 0.0
+        self.samples[key].append(elapsed)
+        self.counts[key] += 1
+        self.totals[key] += elapsed
+        self.maximums[key] = max(self.maximums[key], elapsed)
+
+    def snapshot(self) -> Dict[str, list]:
+        # Компактный вид для снимка метрик воркера: [count, total, p95, max]
+        return {
+            key: [self.counts[key], self.totals[key], _percentile(samples, 0.95), self.maximums[key]]
+            for key, samples in self.samples.items()
+        }
+
+    def report(self, prefix: str = '', top_n: int = 10) -> List[Dict]:
+        return timing_rows(self.snapshot(), prefix, top_n)
+
+    def reset(self):
+        self.samples.clear()
+        self.counts.clear()
+        self.totals.clear()
+        self.maximums.clear()
+
+timings = TimingStats()
+
+def merge_timings(snapshots: List[Dict[str, list]]) -> Dict[str, list]:
+    # p95 по всем воркерам — оценка сверху: максимум из p95 отдельных воркеров
+    merged: Dict[str, list] = {}
+    for snapshot in snapshots:
+        for key, (count, total, p95, maximum) in snapshot.items():
+            if key not in merged:
+                merged[key] = [count, total, p95, maximum]
+                continue
+            row = merged[key]
+            row[0] += count
+            row[1] += total
+            row[2] = max(row[2], p95)
+            row[3] = max(row[3], maximum)
+    return merged
+
+def timing_rows(data: Dict[str, list], prefix: str = '', top_n: int = 10) -> List[Dict]:
+    rows = []
+    for key, (count, total, p95, maximum) in data.items():
+        if not key.startswith(prefix) or not count:
+            continue
+        rows.append({
+            'key': key[len(prefix):],
+            'count': count,
+            'total': total,
+            'avg': total / count,
+            'p95': p95,
+            'max': maximum,
+        })
+    rows.sort(key=lambda row: row['total'], reverse=True)
+    return rows[:top_n]
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.split())[:80]
+
+def log_query_timing(record):
+    # Хук asyncpg (Connection.add_query_logger) — вызывается после каждого запроса
+    key = _normalize_query(record.query)
+    timings.record(f"sql:{key}", record.elapsed)
+    if record.elapsed > SLOW_QUERY_THRESHOLD:
+        print(f"Slow query {record.elapsed:.3f}s: {key}")
+
+# Сэмплирующий профилировщик
+class SamplingProfiler:
+    """Периодически снимает стеки всех потоков через sys._current_frames()"""
+
+    IDLE_FILES = ('selectors.py', 'base_events.py:_run_once', 'threading.py:wait', 'queue.py:get')
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.self_time: Counter = Counter()
+        self.total_samples = 0
+        self.idle_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.stacks.clear()
+        self.self_time.clear()
+        self.total_samples = 0
+        self.idle_samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self._sample(names.get(thread_id, str(thread_id)), frame)
+
+    def _sample(self, thread_name: str, frame):
+        entries = []
+        while frame is not None:
+            code = frame.f_code
+            entries.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if not entries:
+            return
+        entries.reverse()
+        self.total_samples += 1
+        leaf = entries[-1]
+        if any(leaf.startswith(idle) for idle in self.IDLE_FILES):
+            self.idle_samples += 1
+            return
+        self.stacks[";".join([thread_name] + entries)] += 1
+        self.self_time[leaf] += 1
+
+    def folded(self) -> str:
+        # Формат folded stacks для flamegraph.pl / speedscope
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def top(self, top_n: int = 15) -> str:
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            for entry in set(stack.split(";")[1:]):
+                inclusive[entry] += count
+        busy = max(self.total_samples - self.idle_samples, 1)
+        lines = [f"Сэмплов: {self.total_samples} (простой: {self.idle_samples})", "", "🔥 Собственное время:"]
+        for entry, count in self.self_time.most_common(top_n):
+            lines.append(f"{count * 100 / busy:5.1f}% {entry}")
+        lines += ["", "📚 Включительное время:"]
+        for entry, count in inclusive.most_common(top_n):
+            lines.append(f"{count * 100 / busy:5.1f}% {entry}")
+        return "\n".join(lines)
+
+profiler = SamplingProfiler()
+
+# Сторож задержек event loop
+class LoopLagWatchdog:
+    """Измеряет задержку event loop и снимает стек блокирующего кадра из отдельного потока"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD, window: int = 3000):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = deque(maxlen=window)
+        self.offender_counts: Counter = Counter()
+        self.offender_lag: Dict[str, float] = {}
+        self.offender_stacks: Dict[str, str] = {}
+        self.stalls = deque(maxlen=20)
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._pending_offender = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                expected = loop.time() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - expected)
+                self.lags.append(lag)
+                with self._lock:
+                    self._heartbeat = time.monotonic()
+                    offender, self._pending_offender = self._pending_offender, None
+                if lag >= self.threshold:
+                    self._record_stall(lag, offender)
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        # Поток-наблюдатель: если heartbeat давно не обновлялся, loop заблокирован
+        captured_for = None
+        while not self._stop.wait(self.interval / 2):
+            with self._lock:
+                heartbeat = self._heartbeat
+            if time.monotonic() - heartbeat < self.threshold + self.interval or captured_for == heartbeat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self._lock:
+                self._pending_offender = (self._locate(stack), "".join(traceback.format_list(stack[-8:])))
+            captured_for = heartbeat
+
+    @staticmethod
+    def _locate(stack) -> str:
+        # Самый глубокий кадр из кода бота, иначе — верхушка стека
+        own_file = os.path.basename(__file__)
+        for entry in reversed(stack):
+            if os.path.basename(entry.filename) == own_file:
+                return f"{entry.name} ({own_file}:{entry.lineno})"
+        entry = stack[-1]
+        return f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+
+    def _record_stall(self, lag: float, offender):
+        location, stack_text = offender if offender else ("не пойман", "")
+        self.offender_counts[location] += 1
+        self.offender_lag[location] = self.offender_lag.get(location, 0.0) + lag
+        if stack_text:
+            self.offender_stacks[location] = stack_text
+        self.stalls.append((datetime.now(), lag, location))
+        print(f"Event loop blocked for {lag:.2f}s in {location}")
+        if stack_text:
+            print(stack_text.rstrip())
+
+    def stop(self):
+        self._stop.set()
+
+    def percentiles(self) -> Dict[str, float]:
+        samples = list(self.lags)
+        return {
+            'p50': _percentile(samples, 0.50),
+            'p95': _percentile(samples, 0.95),
+            'p99': _percentile(samples, 0.99),
+            'max': max(samples) if samples else 0.0,
+        }
+
+    def snapshot(self) -> Dict:
+        return {
+            **self.percentiles(),
+            'offenders': {location: [self.offender_counts[location], lag] for location, lag in self.offender_lag.items()},
+        }
+
+    def summary(self, top_n: int = 5) -> str:
+        return loop_lag_summary({WORKER_INDEX: self.snapshot()}, top_n)
+
+loop_watchdog = LoopLagWatchdog()
+
+def loop_lag_summary(snapshots: Dict[int, Dict], top_n: int = 5) -> str:
+    # У каждого воркера свой event loop: перцентили показываем по воркерам, блокировки суммируем
+    lines = []
+    for worker, stats in sorted(snapshots.items()):
+        label = f"воркер {worker}: " if len(snapshots) > 1 else ""
+        lines.append(
+            f"• {label}p50: {stats['p50'] * 1000:.0f}ms | p95: {stats['p95'] * 1000:.0f}ms | "
+            f"p99: {stats['p99'] * 1000:.0f}ms | max: {stats['max'] * 1000:.0f}ms"
+        )
+    offenders: Dict[str, list] = {}
+    for stats in snapshots.values():
+        for location, (count, lag) in stats.get('offenders', {}).items():
+            row = offenders.setdefault(location, [0, 0.0])
+            row[0] += count
+            row[1] += lag
+    lines.append(f"• Блокировок > {LOOP_LAG_THRESHOLD:.1f}s: {sum(count for count, _ in offenders.values())}")
+    worst = sorted(offenders.items(), key=lambda item: item[1][1], reverse=True)[:top_n]
+    for location, (count, total) in worst:
+        lines.append(f"• {location}: {count}× / {total:.1f}s")
+    return "\n".join(lines)
 
 # База данных
+def _month_start(moment: datetime, offset: int = 0) -> datetime:
+    index = moment.year * 12 + moment.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1)
+
+class DatabaseUnavailable(Exception):
+    """Postgres недоступен или автомат разомкнут — запрос не выполнялся"""
+
+    def __str__(self):
+        return "база данных временно недоступна"
+
+# Ошибки получения соединения из пула, которые считаются отказом базы
+DB_CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.InterfaceError,
+)
+# Потеря уже выданного соединения; таймауты и ошибки самих запросов сюда не входят
+DB_CONNECTION_LOST_ERRORS = (
+    ConnectionError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.CrashShutdownError,
+)
+
 class Database:
     def __init__(self):
         self.pool = None
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        # Журнал записей, не дошедших до базы: воспроизводится после восстановления
+        self.journal: deque = deque()
+        self.journal_lock = asyncio.Lock()
+        self.stats = Counter()
+        self.ready = asyncio.Event()
         
-    async def connect(self):
+    async def connect(self) -> bool:
+        started = time.perf_counter()
         try:
             self.pool = await asyncpg.create_pool(
                 DATABASE_URL,
-                min_size=1,
-                max_size=10,
-                command_timeout=60
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                command_timeout=60,
+                init=self._init_connection
             )
-            await self.create_tables()
-            print("Database connected successfully")
+            await self.warm_up()
+            startup.record("подключение к БД и прогрев пула", time.perf_counter() - started)
         except Exception as e:
             print(f"Database connection error: {e}")
+            if self.pool:
+                self.pool.terminate()
+                self.pool = None
+            self._record_failure()
+            return False
+        
+        self._record_success()
+        try:
+            await self.migrate()
+        except Exception as e:
+            print(f"Database schema error: {e}")
+        print(f"Database connected successfully (pool {DB_POOL_MIN}-{DB_POOL_MAX})")
+        self.ready.set()
+        return True
+
+    async def migrate(self):
+        # create_tables выполняется только если версия схемы в базе отстаёт от кода
+        async with self.acquire() as conn:
+            with startup.phase("проверка схемы"):
+                await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+                if await conn.fetchval('SELECT MAX(version) FROM schema_version') == SCHEMA_VERSION:
+                    return
+            # Воркеры стартуют одновременно: схему обновляет один, остальные ждут и перепроверяют
+            await conn.execute('SELECT pg_advisory_lock($1)', SCHEMA_LOCK_ID)
+            try:
+                if await conn.fetchval('SELECT MAX(version) FROM schema_version') == SCHEMA_VERSION:
+                    return
+                with startup.phase("create_tables"):
+                    await self.create_tables()
+                await conn.execute('DELETE FROM schema_version')
+                await conn.execute('INSERT INTO schema_version (version) VALUES ($1)', SCHEMA_VERSION)
+                print(f"✅ Схема базы обновлена до версии {SCHEMA_VERSION}")
+            finally:
+                await conn.execute('SELECT pg_advisory_unlock($1)', SCHEMA_LOCK_ID)
+
+    async def warm_up(self):
+        # Все min_size соединений открыты и проверены до первого запроса пользователя
+        async def ping():
+            async with self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+                await conn.fetchval('SELECT 1')
+        await asyncio.gather(*(ping() for _ in range(DB_POOL_MIN)))
+
+    async def _init_connection(self, conn):
+        # Замер времени каждого SQL запроса (asyncpg >= 0.29)
+        if hasattr(conn, 'add_query_logger'):
+            conn.add_query_logger(log_query_timing)
+
+    # Автомат: после DB_BREAKER_THRESHOLD отказов подряд запросы сразу отклоняются на DB_BREAKER_COOLDOWN секунд
+    @property
+    def state(self) -> str:
+        if not self.pool:
+            return 'offline'
+        if self.failures < DB_BREAKER_THRESHOLD:
+            return 'closed'
+        return 'open' if time.monotonic() < self.open_until else 'half-open'
+
+    @property
+    def available(self) -> bool:
+        state = self.state
+        return state == 'closed' or (state == 'half-open' and not self.probing)
+
+    def _record_failure(self):
+        self.failures += 1
+        self.stats['failures'] += 1
+        if self.failures >= DB_BREAKER_THRESHOLD:
+            if self.time_to_retry() == 0:
+                self.stats['breaker_opened'] += 1
+                print(f"⚠️ База недоступна, автомат разомкнут на {DB_BREAKER_COOLDOWN} сек")
+            self.open_until = time.monotonic() + DB_BREAKER_COOLDOWN
+
+    def _record_success(self):
+        if self.failures >= DB_BREAKER_THRESHOLD:
+            print("✅ База снова доступна")
+        self.failures = 0
+        self.open_until = 0.0
+
+    def time_to_retry(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Соединение из пула под защитой автомата; при недоступности — DatabaseUnavailable"""
+        state = self.state
+        if state in ('offline', 'open') or (state == 'half-open' and self.probing):
+            self.stats['rejected'] += 1
+            raise DatabaseUnavailable()
+        # В полуоткрытом состоянии пропускаем один пробный запрос
+        probe = state == 'half-open'
+        self.probing = self.probing or probe
+        try:
+            try:
+                conn = await self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+            except asyncio.TimeoutError as e:
+                if self.pool.get_size() >= DB_POOL_MAX:
+                    # Все соединения заняты: база жива, пул исчерпан — автомат не размыкаем
+                    self.stats['pool_exhausted'] += 1
+                else:
+                    self._record_failure()
+                raise DatabaseUnavailable() from e
+            except DB_CONNECTION_ERRORS as e:
+                self._record_failure()
+                raise DatabaseUnavailable() from e
+            try:
+                yield conn
+            except DB_CONNECTION_LOST_ERRORS as e:
+                self._record_failure()
+                raise DatabaseUnavailable() from e
+            else:
+                self._record_success()
+            finally:
+                await self.pool.release(conn)
+        finally:
+            if probe:
+                self.probing = False
+
+    async def write(self, operation: Callable[..., Awaitable], *args):
+        """Выполняет запись, а при недоступной базе откладывает её в журнал"""
+        if self.journal:
+            # Пока журнал не пуст, новая запись встаёт за ним: иначе старая перезапишет её при воспроизведении,
+            # а скачивания попадут в базу раньше пользователя, на которого ссылаются
+            self._journal(operation, args)
+            if not self.journal_lock.locked():
+                await self.replay_journal()
+            return
+        try:
+            async with self.acquire() as conn:
+                await operation(conn, *args)
+        except DatabaseUnavailable:
+            if not DATABASE_URL:
+                # Базы нет вовсе: воспроизводить журнал будет некуда
+                return
+            self._journal(operation, args)
+
+    def _journal(self, operation: Callable[..., Awaitable], args: tuple):
+        # Переполненный журнал не принимает новые записи: старые не вытесняются молча
+        if len(self.journal) >= DB_JOURNAL_LIMIT:
+            if not self.stats['journal_dropped']:
+                print(f"⚠️ Журнал записей заполнен ({DB_JOURNAL_LIMIT}), новые записи отбрасываются")
+            self.stats['journal_dropped'] += 1
+            self.stats[f'journal_dropped:{operation.__name__}'] += 1
+            return
+        self.journal.append((operation, args))
+        self.stats['journaled'] += 1
+
+    async def replay_journal(self):
+        # Один воспроизводящий за раз: записи выполняются строго по порядку
+        async with self.journal_lock:
+            while self.journal and self.available:
+                operation, args = self.journal[0]
+                try:
+                    async with self.acquire() as conn:
+                        await operation(conn, *args)
+                except DatabaseUnavailable:
+                    return
+                except Exception as e:
+                    print(f"Journal replay error ({operation.__name__}): {e}")
+                    self.stats['journal_failed'] += 1
+                self.journal.popleft()
+                self.stats['replayed'] += 1
+
+    async def health_loop(self):
+        # Первая итерация и есть подключение при старте: оно идёт параллельно с запуском приложения
+        while True:
+            try:
+                if not self.pool:
+                    await self.connect()
+                elif self.state == 'half-open' or self.journal:
+                    async with self.acquire() as conn:
+                        await conn.fetchval('SELECT 1')
+                if self.available:
+                    await self.replay_journal()
+            except DatabaseUnavailable:
+                pass
+            except Exception as e:
+                print(f"DB health check error: {e}")
+            await asyncio.sleep(DB_HEALTH_INTERVAL)
+
+    def summary(self) -> str:
+        return (
+            f"• Состояние: {self.state} | отказов подряд: {self.failures}\n"
+            f"• Пул: {self.pool.get_size() if self.pool else 0}/{DB_POOL_MAX} (свободно {self.pool.get_idle_size() if self.pool else 0}, "
+            f"исчерпан {self.stats['pool_exhausted']} раз)\n"
+            f"• Отклонено автоматом: {self.stats['rejected']} | в журнале: {len(self.journal)} | воспроизведено: {self.stats['replayed']}\n"
+            f"• Отброшено при полном журнале: {self.stats['journal_dropped']}"
+        )
     
     async def create_tables(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     user_id BIGINT PRIMARY KEY,
@@ -128,6 +852,10 @@ class Database:
                 )
             ''')
             
+            # Индексы для keyset-пагинации списка пользователей
+            await conn.execute('CREATE INDEX IF NOT EXISTS users_created_idx ON users (created_at, user_id) WHERE created_at IS NOT NULL')
+            await conn.execute('CREATE INDEX IF NOT EXISTS users_premium_created_idx ON users (created_at, user_id) WHERE is_premium')
+            
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS downloads (
                     id SERIAL PRIMARY KEY,
@@ -138,6 +866,91 @@ class Database:
                 )
             ''')
             
+            # Источник трека для повторной доставки и локального поиска
+            await conn.execute('''
+                ALTER TABLE downloads
+                    ADD COLUMN IF NOT EXISTS url VARCHAR(1000),
+                    ADD COLUMN IF NOT EXISTS source VARCHAR(20),
+                    ADD COLUMN IF NOT EXISTS duration_seconds INTEGER,
+                    ADD COLUMN IF NOT EXISTS uploader VARCHAR(200)
+            ''')
+            await self._partition_downloads(conn)
+            await conn.execute('CREATE INDEX IF NOT EXISTS downloads_user_time_idx ON downloads (user_id, downloaded_at, id)')
+            
+            await conn.execute('''
+                CREATE UNLOGGED TABLE IF NOT EXISTS shared_state (
+                    namespace VARCHAR(50),
+                    key VARCHAR(200),
+                    value JSONB,
+                    expires_at TIMESTAMP,
+                    PRIMARY KEY (namespace, key)
+                )
+            ''')
+            
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS track_cache (
+                    url VARCHAR(1000),
+                    bitrate INTEGER,
+                    file_id VARCHAR(200) NOT NULL,
+                    title VARCHAR(500),
+                    performer VARCHAR(200),
+                    duration_seconds INTEGER,
+                    cached_at TIMESTAMP DEFAULT NOW(),
+                    PRIMARY KEY (url, bitrate)
+                )
+            ''')
+            
+            for table, bucket_type in (('hourly', 'TIMESTAMP'), ('daily', 'DATE')):
+                await conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS download_stats_{table} (
+                        bucket {bucket_type} PRIMARY KEY,
+                        downloads INTEGER DEFAULT 0,
+                        failures INTEGER DEFAULT 0,
+                        duration_seconds BIGINT DEFAULT 0,
+                        unique_users INTEGER DEFAULT 0,
+                        latency_histogram INTEGER[]
+                    )
+                ''')
+                await conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS download_users_{table} (
+                        bucket {bucket_type},
+                        user_id BIGINT,
+                        PRIMARY KEY (bucket, user_id)
+                    )
+                ''')
+            
+            # Разовое заполнение агрегатов из накопленной истории
+            if not await conn.fetchval('SELECT EXISTS (SELECT 1 FROM download_stats_daily)'):
+                for table, bucket_expr in (('hourly', "date_trunc('hour', downloaded_at)"), ('daily', 'downloaded_at::date')):
+                    await conn.execute(f'''
+                        INSERT INTO download_stats_{table} (bucket, downloads, duration_seconds, unique_users, latency_histogram)
+                        SELECT {bucket_expr}, COUNT(*), COALESCE(SUM(duration_seconds), 0), COUNT(DISTINCT user_id),
+                               array_fill(0, ARRAY[{len(LATENCY_BUCKETS) + 1}])
+                        FROM downloads
+                        GROUP BY 1
+                        ON CONFLICT DO NOTHING
+                    ''')
+            
+            # Обновления, принятые, но не обработанные до остановки инстанса
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS pending_updates (
+                    id BIGSERIAL PRIMARY KEY,
+                    payload JSONB NOT NULL,
+                    created_at TIMESTAMP DEFAULT NOW()
+                )
+            ''')
+            
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS chart_slices (
+                    worker INTEGER,
+                    window_name TEXT,
+                    slice_start BIGINT,
+                    counters JSONB,
+                    tracks JSONB,
+                    PRIMARY KEY (worker, window_name, slice_start)
+                )
+            ''')
+            
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS favorites (
                     id SERIAL PRIMARY KEY,
@@ -147,53 +960,1100 @@ class Database:
                     added_at TIMESTAMP DEFAULT NOW()
                 )
             ''')
+            
+            # Данные для повторной доставки и по одной записи на трек у пользователя
+            await conn.execute('''
+                ALTER TABLE favorites
+                    ADD COLUMN IF NOT EXISTS source VARCHAR(20),
+                    ADD COLUMN IF NOT EXISTS duration_seconds INTEGER,
+                    ADD COLUMN IF NOT EXISTS uploader VARCHAR(200)
+            ''')
+            await conn.execute('''
+                DELETE FROM favorites a USING favorites b
+                WHERE a.user_id = b.user_id AND a.url = b.url AND a.id > b.id
+            ''')
+            await conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS favorites_user_url_idx ON favorites (user_id, url)')
+            await conn.execute('CREATE INDEX IF NOT EXISTS favorites_user_time_idx ON favorites (user_id, added_at, id)')
+
+    # Помесячные партиции downloads
+    async def _partition_downloads(self, conn):
+        relkind = await conn.fetchval("SELECT relkind FROM pg_class WHERE oid = 'downloads'::regclass")
+        if relkind == 'p':
+            return
+        
+        # Разовая миграция обычной таблицы в секционированную; id продолжают ту же последовательность
+        async with conn.transaction():
+            await conn.execute('ALTER TABLE downloads RENAME TO downloads_legacy')
+            await conn.execute('''
+                CREATE TABLE downloads (
+                    id BIGINT NOT NULL DEFAULT nextval('downloads_id_seq'),
+                    user_id BIGINT REFERENCES users(user_id),
+                    title VARCHAR(500),
+                    duration VARCHAR(20),
+                    downloaded_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    url VARCHAR(1000),
+                    source VARCHAR(20),
+                    duration_seconds INTEGER,
+                    uploader VARCHAR(200),
+                    PRIMARY KEY (id, downloaded_at)
+                ) PARTITION BY RANGE (downloaded_at)
+            ''')
+            await conn.execute('ALTER SEQUENCE downloads_id_seq OWNED BY downloads.id')
+            oldest = await conn.fetchval('SELECT MIN(downloaded_at) FROM downloads_legacy') or datetime.now()
+            await self.ensure_download_partitions(conn, oldest)
+            moved = await conn.execute('''
+                INSERT INTO downloads (id, user_id, title, duration, downloaded_at, url, source, duration_seconds, uploader)
+                SELECT id, user_id, title, duration, COALESCE(downloaded_at, NOW()), url, source, duration_seconds, uploader
+                FROM downloads_legacy
+            ''')
+            await conn.execute('DROP TABLE downloads_legacy')
+        print(f"✅ downloads переведена на помесячные партиции ({moved})")
+
+    async def ensure_download_partitions(self, conn, since: Optional[datetime] = None):
+        # Партиции от месяца since (по умолчанию текущего) и на DOWNLOADS_PARTITIONS_AHEAD месяцев вперёд
+        month = _month_start(since or datetime.now())
+        last = _month_start(datetime.now(), DOWNLOADS_PARTITIONS_AHEAD)
+        while month <= last:
+            following = _month_start(month, 1)
+            await conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS downloads_{month:%Y_%m} PARTITION OF downloads
+                FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')
+            ''')
+            month = following
+
+    async def maintain_download_partitions(self) -> List[str]:
+        """Создаёт будущие партиции и отсоединяет те, что старше срока хранения"""
+        if not self.available:
+            return []
+        archived = []
+        cutoff = _month_start(datetime.now(), -DOWNLOADS_RETENTION_MONTHS)
+        async with self.acquire() as conn:
+            await self.ensure_download_partitions(conn)
+            partitions = await conn.fetch('''
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'downloads'::regclass
+            ''')
+            for row in partitions:
+                name = row['relname']
+                try:
+                    month = datetime.strptime(name, 'downloads_%Y_%m')
+                except ValueError:
+                    continue
+                if month >= cutoff:
+                    continue
+                # История месяца уже есть в дневных агрегатах, поэтому сырые строки можно убрать
+                await conn.execute(f'ALTER TABLE downloads DETACH PARTITION {name}')
+                if DOWNLOADS_ARCHIVE_MODE == 'drop':
+                    await conn.execute(f'DROP TABLE {name}')
+                else:
+                    await conn.execute(f'ALTER TABLE {name} RENAME TO {name.replace("downloads_", "downloads_archive_", 1)}')
+                archived.append(name)
+            
+            # Часовые агрегаты нужны только для последних суток, дневные храним всегда
+            await conn.execute(
+                "DELETE FROM download_stats_hourly WHERE bucket < NOW() - make_interval(days => $1)",
+                ROLLUP_HOURLY_RETENTION_DAYS
+            )
+        return archived
 
     async def get_user(self, user_id: int) -> Optional[Dict]:
-        if not self.pool:
+        try:
+            async with self.acquire() as conn:
+                row = await conn.fetchrow(
+                    'SELECT * FROM users WHERE user_id = $1', user_id
+                )
+                return dict(row) if row else None
+        except DatabaseUnavailable:
+            return None
+    
+    async def create_user(self, user_id: int, username: str = None, first_name: str = None):
+        await self.write(_upsert_user, user_id, username, first_name)
+    
+    async def get_language(self, user_id: int) -> Optional[str]:
+        try:
+            async with self.acquire() as conn:
+                return await conn.fetchval('SELECT language_code FROM users WHERE user_id = $1', user_id)
+        except DatabaseUnavailable:
+            return None
+    
+    async def set_language(self, user_id: int, lang: str):
+        await self.write(_store_language, user_id, lang)
+    
+    # История и избранное
+    async def library_page(self, kind: str, user_id: int, cursor: Optional[tuple] = None, newer: bool = False) -> tuple:
+        # Keyset по (время, id) через индексы (user_id, время, id)
+        table, time_column = LIBRARY_VIEWS[kind][:2]
+        params = [user_id]
+        condition = ''
+        if cursor:
+            params.extend(cursor)
+            condition = f"AND ({time_column}, id) {'>' if newer else '<'} ($2, $3)"
+        order = 'ASC' if newer else 'DESC'
+        params.append(LIBRARY_PAGE_SIZE + 1)
+        async with self.acquire() as conn:
+            rows = await conn.fetch(f'''
+                SELECT id, title, url, source, duration_seconds, uploader, {time_column} AS at
+                FROM {table}
+                WHERE user_id = $1 AND url IS NOT NULL {condition}
+                ORDER BY {time_column} {order}, id {order}
+                LIMIT ${len(params)}
+            ''', *params)
+        has_more = len(rows) > LIBRARY_PAGE_SIZE
+        rows = [dict(row) for row in rows[:LIBRARY_PAGE_SIZE]]
+        if newer:
+            rows.reverse()
+        return rows, has_more
+
+    async def favorite_urls(self, user_id: int, urls: List[str]) -> set:
+        if not self.available or not urls:
+            return set()
+        try:
+            async with self.acquire() as conn:
+                rows = await conn.fetch('SELECT url FROM favorites WHERE user_id = $1 AND url = ANY($2)', user_id, urls)
+            return {row['url'] for row in rows}
+        except Exception as e:
+            print(f"Favorites read error: {e}")
+            return set()
+
+    async def toggle_favorite(self, user_id: int, track: Dict) -> bool:
+        """Добавляет трек в избранное или убирает его оттуда; возвращает новое состояние"""
+        async with self.acquire() as conn:
+            removed = await conn.fetchval(
+                'DELETE FROM favorites WHERE user_id = $1 AND url = $2 RETURNING id', user_id, track['url']
+            )
+            if removed:
+                return False
+            await conn.execute('''
+                INSERT INTO favorites (user_id, title, url, source, duration_seconds, uploader)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (user_id, url) DO NOTHING
+            ''', user_id, track['title'], track['url'], track.get('source'), track.get('duration_seconds'), track.get('uploader'))
+            return True
+
+    async def remove_favorite(self, user_id: int, url: str) -> bool:
+        """Только удаление: повторное нажатие 💔 не вернёт трек в избранное"""
+        async with self.acquire() as conn:
+            removed = await conn.fetchval('DELETE FROM favorites WHERE user_id = $1 AND url = $2 RETURNING id', user_id, url)
+        return removed is not None
+
+    async def get_user_stats(self) -> Dict:
+        try:
+            async with self.acquire() as conn:
+                total_users = await conn.fetchval('SELECT COUNT(*) FROM users')
+                premium_users = await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_premium = TRUE')
+                # Сумма по дневным агрегатам: стоимость не растёт с историей и переживает архивацию партиций
+                total_downloads = await conn.fetchval('SELECT SUM(downloads) FROM download_stats_daily')
+        except DatabaseUnavailable:
+            return {"total_users": 0, "premium_users": 0, "total_downloads": 0}
+        return {
+            "total_users": total_users or 0,
+            "premium_users": premium_users or 0,
+            "total_downloads": total_downloads or 0
+        }
+
+# Записи, которые при недоступной базе уходят в журнал и воспроизводятся позже
+async def _upsert_user(conn, user_id: int, username: Optional[str], first_name: Optional[str]):
+    await conn.execute('''
+        INSERT INTO users (user_id, username, first_name) 
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = $2,
+            first_name = $3,
+            last_activity = NOW()
+    ''', user_id, username, first_name)
+
+async def _store_language(conn, user_id: int, lang: str):
+    await conn.execute('UPDATE users SET language_code = $2 WHERE user_id = $1', user_id, lang)
+
+async def _store_downloads(conn, user_id: int, tracks: List[Dict], moment: datetime):
+    # Время фиксируется при скачивании, чтобы отложенная запись попала в свой день
+    async with conn.transaction():
+        await conn.execute('''
+            UPDATE users SET 
+                total_downloads = total_downloads + $2,
+                daily_downloads = CASE 
+                    WHEN last_download_date = $3 THEN daily_downloads + $2
+                    ELSE $2
+                END,
+                last_download_date = $3
+            WHERE user_id = $1 AND (last_download_date IS NULL OR last_download_date <= $3)
+        ''', user_id, len(tracks), moment.date())
+        
+        await conn.executemany('''
+            INSERT INTO downloads (user_id, title, duration, url, source, duration_seconds, uploader, downloaded_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        ''', [
+            (user_id, track['title'], track['duration'], track['url'],
+             track.get('source'), track.get('duration_seconds'), track.get('uploader'), moment)
+            for track in tracks
+        ])
+
+async def _store_track_cache(conn, track: Dict, file_id: str, bitrate: int):
+    await conn.execute('''
+        INSERT INTO track_cache (url, bitrate, file_id, title, performer, duration_seconds)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (url, bitrate) DO UPDATE SET
+            file_id = EXCLUDED.file_id,
+            cached_at = NOW()
+    ''', track['url'], bitrate, file_id, track['title'], track.get('uploader'), track.get('duration_seconds'))
+
+# Инициализация базы данных
+db = Database()
+
+# Общее состояние воркеров
+class MemoryStateBackend:
+    """Состояние в памяти процесса (режим одного воркера)"""
+
+    def __init__(self):
+        self.data: Dict[tuple, tuple] = {}
+
+    async def get(self, namespace: str, key) -> Any:
+        entry = self.data.get((namespace, str(key)))
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at and expires_at < time.time():
+            self.data.pop((namespace, str(key)), None)
+            return None
+        return value
+
+    async def set(self, namespace: str, key, value, ttl: Optional[int] = None):
+        expires_at = time.time() + ttl if ttl else None
+        self.data[(namespace, str(key))] = (value, expires_at)
+
+    async def delete(self, namespace: str, key):
+        self.data.pop((namespace, str(key)), None)
+
+    async def purge_expired(self):
+        now = time.time()
+        for item_key in [k for k, (_, expires_at) in self.data.items() if expires_at and expires_at < now]:
+            self.data.pop(item_key, None)
+
+class PostgresStateBackend:
+    """Состояние в UNLOGGED таблице Postgres — общее для всех воркеров"""
+
+    def __init__(self, database: 'Database'):
+        self.db = database
+
+    async def get(self, namespace: str, key) -> Any:
+        async with self.db.acquire() as conn:
+            value = await conn.fetchval(
+                '''SELECT value FROM shared_state
+                   WHERE namespace = $1 AND key = $2
+                     AND (expires_at IS NULL OR expires_at > NOW())''',
+                namespace, str(key)
+            )
+        return json.loads(value) if value is not None else None
+
+    async def set(self, namespace: str, key, value, ttl: Optional[int] = None):
+        async with self.db.acquire() as conn:
+            await conn.execute(
+                '''INSERT INTO shared_state (namespace, key, value, expires_at)
+                   VALUES ($1, $2, $3, CASE WHEN $4::int IS NULL THEN NULL ELSE NOW() + make_interval(secs => $4::int) END)
+                   ON CONFLICT (namespace, key) DO UPDATE SET
+                       value = EXCLUDED.value,
+                       expires_at = EXCLUDED.expires_at''',
+                namespace, str(key), json.dumps(value), ttl
+            )
+
+    async def delete(self, namespace: str, key):
+        async with self.db.acquire() as conn:
+            await conn.execute('DELETE FROM shared_state WHERE namespace = $1 AND key = $2', namespace, str(key))
+
+    async def purge_expired(self):
+        async with self.db.acquire() as conn:
+            await conn.execute('DELETE FROM shared_state WHERE expires_at < NOW()')
+
+class SharedState:
+    def __init__(self):
+        self.backend = MemoryStateBackend()
+        # Деградация: пока база недоступна, состояние живёт в памяти процесса
+        self.fallback = MemoryStateBackend()
+
+    @property
+    def is_shared(self) -> bool:
+        return isinstance(self.backend, PostgresStateBackend)
+
+    def use(self, backend):
+        self.backend = backend
+
+    async def get(self, namespace: str, key) -> Any:
+        try:
+            value = await self.backend.get(namespace, key)
+        except DatabaseUnavailable:
+            value = None
+        if value is None and self.is_shared:
+            value = await self.fallback.get(namespace, key)
+        return value
+
+    async def set(self, namespace: str, key, value, ttl: Optional[int] = None):
+        try:
+            await self.backend.set(namespace, key, value, ttl)
+        except DatabaseUnavailable:
+            await self.fallback.set(namespace, key, value, ttl)
+
+    async def delete(self, namespace: str, key):
+        await self.fallback.delete(namespace, key)
+        try:
+            await self.backend.delete(namespace, key)
+        except DatabaseUnavailable:
+            pass
+
+    async def purge_expired(self):
+        await self.fallback.purge_expired()
+        try:
+            await self.backend.purge_expired()
+        except DatabaseUnavailable:
+            pass
+
+shared_state = SharedState()
+
+# Метрики воркеров: каждый процесс пишет снимок в METRICS_DIR, чтение агрегирует все
+def _metrics_snapshot() -> Dict:
+    return {
+        "pid": os.getpid(),
+        "worker": WORKER_INDEX,
+        "messages": user_stats['messages'],
+        "downloads": user_stats['downloads'],
+        "users": list(user_stats['users']),
+        "timings": timings.snapshot(),
+        "loop_lag": loop_watchdog.snapshot(),
+        "queue": update_queue.snapshot(),
+        "admission": admission.counters(),
+        "updated_at": time.time(),
+    }
+
+def write_metrics_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    snapshot = _metrics_snapshot()
+    path = os.path.join(METRICS_DIR, f"worker-{WORKER_INDEX}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+def aggregate_metrics() -> Dict:
+    totals = {
+        "messages": 0, "downloads": 0, "users": set(), "workers": 0,
+        "loop_lag": {}, "admission": Counter(),
+        "queue": {"size": 0, "maxsize": 0, "users": 0, "stats": Counter()},
+    }
+    # Свой процесс берём живыми цифрами, остальных — из последних снимков
+    snapshots = [_metrics_snapshot()]
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if snapshot.get('pid') != os.getpid():
+            snapshots.append(snapshot)
+    timing_snapshots = []
+    for snapshot in snapshots:
+        if time.time() - snapshot.get('updated_at', 0) > METRICS_STALE_AFTER:
+            continue
+        totals["workers"] += 1
+        totals["messages"] += snapshot.get('messages', 0)
+        totals["downloads"] += snapshot.get('downloads', 0)
+        totals["users"].update(snapshot.get('users', []))
+        timing_snapshots.append(snapshot.get('timings', {}))
+        if snapshot.get('loop_lag'):
+            totals["loop_lag"][snapshot.get('worker', 0)] = snapshot['loop_lag']
+        totals["admission"].update(snapshot.get('admission', {}))
+        queue = snapshot.get('queue')
+        if queue:
+            for field in ('size', 'maxsize', 'users'):
+                totals["queue"][field] += queue[field]
+            stats = Counter(queue['stats'])
+            peak = max(totals["queue"]["stats"]['peak'], stats.pop('peak', 0))
+            totals["queue"]["stats"].update(stats)
+            totals["queue"]["stats"]['peak'] = peak
+    totals["timings"] = merge_timings(timing_snapshots)
+    return totals
+
+async def metrics_flush_loop():
+    while True:
+        try:
+            write_metrics_snapshot()
+            if WORKER_INDEX == 0:
+                await shared_state.purge_expired()
+        except Exception as e:
+            print(f"Metrics flush error: {e}")
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+# Агрегаты скачиваний по часам и дням
+def _latency_bin(latency: float) -> int:
+    return bisect.bisect_left(LATENCY_BUCKETS, latency)
+
+def histogram_percentile(histogram: List[int], q: float) -> Optional[float]:
+    total = sum(histogram)
+    if not total:
+        return None
+    threshold = q * total
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= threshold:
+            return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float('inf')
+    return float('inf')
+
+class DownloadRollups:
+    """События скачиваний копятся в памяти и сливаются UPSERT-ами в часовые и дневные агрегаты"""
+
+    def __init__(self, database: 'Database'):
+        self.db = database
+        self.pending: Dict[datetime, Dict] = {}
+
+    def record(self, user_id: int, success: bool, duration_seconds: int = 0, latency: Optional[float] = None):
+        bucket = datetime.now().replace(minute=0, second=0, microsecond=0)
+        entry = self.pending.get(bucket)
+        if entry is None:
+            entry = self.pending[bucket] = {
+                'downloads': 0, 'failures': 0, 'duration': 0,
+                'users': set(), 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+            }
+        if success:
+            entry['downloads'] += 1
+            entry['duration'] += int(duration_seconds or 0)
+            entry['users'].add(user_id)
+        else:
+            entry['failures'] += 1
+        if latency is not None:
+            entry['histogram'][_latency_bin(latency)] += 1
+
+    async def flush(self):
+        if not self.pending or not self.db.available:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with self.db.acquire() as conn:
+                async with conn.transaction():
+                    for bucket, entry in pending.items():
+                        for table, key in (('hourly', bucket), ('daily', bucket.date())):
+                            await conn.execute(f'''
+                                WITH new_users AS (
+                                    INSERT INTO download_users_{table} (bucket, user_id)
+                                    SELECT $1, unnest($2::bigint[])
+                                    ON CONFLICT DO NOTHING
+                                    RETURNING 1
+                                )
+                                INSERT INTO download_stats_{table} AS s
+                                    (bucket, downloads, failures, duration_seconds, unique_users, latency_histogram)
+                                VALUES ($1, $3, $4, $5, (SELECT COUNT(*) FROM new_users), $6)
+                                ON CONFLICT (bucket) DO UPDATE SET
+                                    downloads = s.downloads + EXCLUDED.downloads,
+                                    failures = s.failures + EXCLUDED.failures,
+                                    duration_seconds = s.duration_seconds + EXCLUDED.duration_seconds,
+                                    unique_users = s.unique_users + EXCLUDED.unique_users,
+                                    latency_histogram = (
+                                        SELECT array_agg(COALESCE(a, 0) + COALESCE(b, 0) ORDER BY i)
+                                        FROM unnest(s.latency_histogram, EXCLUDED.latency_histogram) WITH ORDINALITY AS t(a, b, i)
+                                    )
+                            ''', key, list(entry['users']), entry['downloads'], entry['failures'],
+                                entry['duration'], entry['histogram'])
+                    
+                    # Списки пользователей нужны только для дедупликации в текущем часе/дне
+                    await conn.execute("DELETE FROM download_users_hourly WHERE bucket < date_trunc('hour', NOW()) - INTERVAL '1 hour'")
+                    await conn.execute("DELETE FROM download_users_daily WHERE bucket < CURRENT_DATE - 1")
+        except Exception as e:
+            print(f"Rollup flush error: {e}")
+            # Возвращаем события в буфер, чтобы не потерять их до следующей попытки
+            for bucket, entry in pending.items():
+                current = self.pending.setdefault(bucket, entry)
+                if current is not entry:
+                    for field in ('downloads', 'failures', 'duration'):
+                        current[field] += entry[field]
+                    current['users'] |= entry['users']
+                    current['histogram'] = [a + b for a, b in zip(current['histogram'], entry['histogram'])]
+
+    async def fetch(self, table: str, since: datetime) -> List[Dict]:
+        if not self.db.available:
+            return []
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch(
+                f'SELECT * FROM download_stats_{table} WHERE bucket >= $1 ORDER BY bucket DESC',
+                since.date() if table == 'daily' else since
+            )
+        return [dict(row) for row in rows]
+
+rollups = DownloadRollups(db)
+
+async def rollup_flush_loop():
+    while True:
+        await asyncio.sleep(ROLLUP_FLUSH_INTERVAL)
+        await rollups.flush()
+
+async def partition_maintenance_loop():
+    await db.ready.wait()
+    while True:
+        try:
+            archived = await db.maintain_download_partitions()
+            if archived:
+                print(f"🗄️ Партиции downloads отправлены в архив: {', '.join(archived)}")
+        except Exception as e:
+            print(f"Partition maintenance error: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+# Чарты: Space-Saving счётчики по временным срезам, с чекпоинтами в Postgres
+class SpaceSaving:
+    """Приближённый top-k: не больше capacity счётчиков, вытесняется минимальный"""
+
+    def __init__(self, capacity: int, counters: Optional[Dict[str, List[int]]] = None):
+        self.capacity = capacity
+        self.counters: Dict[str, List[int]] = counters or {}
+
+    def add(self, key: str, weight: int = 1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+class TrendingCharts:
+    # окно -> (длина среза в секундах, количество срезов)
+    WINDOWS = {'hour': (600, 6), 'day': (3600, 24), 'week': (86400, 7)}
+
+    def __init__(self, database: 'Database'):
+        self.db = database
+        self.slices: Dict[str, OrderedDict] = {window: OrderedDict() for window in self.WINDOWS}
+        self.tracks: OrderedDict = OrderedDict()
+        self.dirty = set()
+
+    def _current(self, window: str, now: float) -> SpaceSaving:
+        width, count = self.WINDOWS[window]
+        start = int(now // width * width)
+        slices = self.slices[window]
+        if start not in slices:
+            slices[start] = SpaceSaving(CHARTS_CAPACITY)
+            while slices and next(iter(slices)) <= start - width * count:
+                slices.popitem(last=False)
+        return slices[start]
+
+    def record(self, track: Dict, weight: int):
+        url = track.get('url')
+        if not url:
+            return
+        self.tracks[url] = {key: track.get(key) for key in ('url', 'title', 'duration', 'duration_seconds', 'uploader', 'source')}
+        self.tracks.move_to_end(url)
+        while len(self.tracks) > CHARTS_CAPACITY * 20:
+            self.tracks.popitem(last=False)
+        now = time.time()
+        for window in self.WINDOWS:
+            self._current(window, now).add(url, weight)
+            width = self.WINDOWS[window][0]
+            self.dirty.add((window, int(now // width * width)))
+
+    def record_download(self, track: Dict):
+        self.record(track, CHARTS_DOWNLOAD_WEIGHT)
+
+    def record_search(self, results: List[Dict]):
+        if results:
+            self.record(results[0], 1)
+
+    async def _remote_slices(self, window: str, since: int) -> List[Dict]:
+        # Срезы других воркеров читаем из их последних чекпоинтов
+        if WEB_WORKERS <= 1 or not self.db.available:
+            return []
+        async with self.db.acquire() as conn:
+            rows = await conn.fetch('''
+                SELECT counters, tracks FROM chart_slices
+                WHERE window_name = $1 AND slice_start > $2 AND worker <> $3
+            ''', window, since, WORKER_INDEX)
+        return [{'counters': json.loads(row['counters']), 'tracks': json.loads(row['tracks'])} for row in rows]
+
+    async def top(self, window: str, limit: int) -> List[Dict]:
+        width, count = self.WINDOWS[window]
+        since = int(time.time() // width * width) - width * count
+        totals: Counter = Counter()
+        tracks = {}
+        for start, sketch in self.slices[window].items():
+            if start > since:
+                for url, (value, _) in sketch.counters.items():
+                    totals[url] += value
+        try:
+            for remote in await self._remote_slices(window, since):
+                for url, (value, _) in remote['counters'].items():
+                    totals[url] += value
+                tracks.update(remote['tracks'])
+        except Exception as e:
+            print(f"Charts remote read error: {e}")
+        tracks.update(self.tracks)
+        
+        chart = []
+        for url, score in totals.most_common():
+            track = tracks.get(url)
+            if not track:
+                continue
+            track = dict(track)
+            track['duration'] = track.get('duration') or downloader._format_duration(track.get('duration_seconds'))
+            track['score'] = score
+            chart.append(track)
+            if len(chart) >= limit:
+                break
+        return chart
+
+    async def checkpoint(self):
+        if not self.dirty or not self.db.available:
+            return
+        dirty, self.dirty = self.dirty, set()
+        rows = []
+        for window, start in dirty:
+            sketch = self.slices[window].get(start)
+            if sketch is None:
+                continue
+            tracks = {url: self.tracks[url] for url in sketch.counters if url in self.tracks}
+            rows.append((WORKER_INDEX, window, start, json.dumps(sketch.counters), json.dumps(tracks)))
+        try:
+            async with self.db.acquire() as conn:
+                await conn.executemany('''
+                    INSERT INTO chart_slices (worker, window_name, slice_start, counters, tracks)
+                    VALUES ($1, $2, $3, $4::jsonb, $5::jsonb)
+                    ON CONFLICT (worker, window_name, slice_start) DO UPDATE SET
+                        counters = EXCLUDED.counters, tracks = EXCLUDED.tracks
+                ''', rows)
+                oldest = int(time.time()) - max(width * count for width, count in self.WINDOWS.values()) * 2
+                await conn.execute('DELETE FROM chart_slices WHERE slice_start < $1', oldest)
+        except Exception as e:
+            print(f"Charts checkpoint error: {e}")
+            self.dirty |= dirty
+
+    async def load(self):
+        if not self.db.available:
+            return
+        now = time.time()
+        try:
+            async with self.db.acquire() as conn:
+                rows = await conn.fetch('''
+                    SELECT window_name, slice_start, counters, tracks FROM chart_slices
+                    WHERE worker = $1 ORDER BY slice_start
+                ''', WORKER_INDEX)
+        except Exception as e:
+            print(f"Charts load error: {e}")
+            return
+        for row in rows:
+            window = row['window_name']
+            if window not in self.WINDOWS:
+                continue
+            width, count = self.WINDOWS[window]
+            if row['slice_start'] <= now - width * count:
+                continue
+            self.slices[window][row['slice_start']] = SpaceSaving(CHARTS_CAPACITY, json.loads(row['counters']))
+            self.tracks.update(json.loads(row['tracks']))
+        print(f"✅ Чарты восстановлены: {len(rows)} срезов")
+
+charts = TrendingCharts(db)
+
+async def charts_checkpoint_loop():
+    if DATABASE_URL:
+        await db.ready.wait()
+    await charts.load()
+    while True:
+        await asyncio.sleep(CHARTS_CHECKPOINT_INTERVAL)
+        await charts.checkpoint()
+
+# Федерация поиска по нескольким источникам yt-dlp
+def _parse_search_sources(spec: str) -> List[tuple]:
+    sources = []
+    for item in spec.split(','):
+        prefix, _, deadline = item.strip().partition(':')
+        if prefix:
+            sources.append((prefix, float(deadline or 5)))
+    return sources
+
+def normalize_title(title: str) -> str:
+    # Убираем пометки вроде "(Official Video)" / "[Lyrics]" и всё, кроме букв и цифр
+    cleaned = re.sub(r'[\(\[][^\)\]]*[\)\]]', ' ', (title or '').lower())
+    cleaned = "".join(c if c.isalnum() else ' ' for c in cleaned)
+    return " ".join(cleaned.split())
+
+class SearchFederation:
+    """Параллельный поиск по источникам со своими дедлайнами и объединением результатов"""
+
+    def __init__(self, sources: List[tuple], search_opts: Dict, executor: ThreadPoolExecutor):
+        self.sources = sources
+        self.search_opts = search_opts
+        self.executor = executor
+        self.failures: Counter = Counter()
+        self.disabled_until: Dict[str, float] = {}
+        self.latency = TimingStats(window=200)
+        self.queue_timeouts: Counter = Counter()
+
+    def healthy_sources(self) -> List[tuple]:
+        now = time.monotonic()
+        return [(prefix, deadline) for prefix, deadline in self.sources if self.disabled_until.get(prefix, 0) <= now]
+
+    async def search(self, query: str, max_results: int, cancel_event: Optional[threading.Event] = None,
+                     flat: bool = False) -> List[Dict]:
+        sources = self.healthy_sources() or self.sources
+        tasks = {
+            asyncio.ensure_future(self._search_source(prefix, deadline, query, max_results, cancel_event, flat)): rank
+            for rank, (prefix, deadline) in enumerate(sources)
+        }
+        collected = []
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for position, entry in enumerate(task.result()):
+                        collected.append((tasks[task], position, entry))
+                merged = self._merge(collected)
+                if len(merged) >= max_results:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        return self._merge(collected)[:max_results]
+
+    async def _search_source(self, prefix: str, deadline: float, query: str, max_results: int,
+                             cancel_event: Optional[threading.Event] = None, flat: bool = False) -> List[Dict]:
+        loop = asyncio.get_running_loop()
+        started = asyncio.Event()
+        stop = threading.Event()
+        future = loop.run_in_executor(
+            self.executor, self._extract, prefix, query, max_results, cancel_event, stop,
+            lambda: loop.call_soon_threadsafe(started.set), flat
+        )
+        try:
+            # Дедлайн источника отсчитывается от начала работы: ожидание свободного потока — не отказ источника
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(started.wait(), deadline)
+            if not started.is_set():
+                self.queue_timeouts[prefix] += 1
+                return []
+            began = time.perf_counter()
+            try:
+                entries = await asyncio.wait_for(asyncio.shield(future), deadline)
+            except asyncio.TimeoutError:
+                self._mark_failure(prefix, f"timeout {deadline}s")
+                return []
+            except Exception as e:
+                self._mark_failure(prefix, str(e))
+                return []
+        finally:
+            if not future.done():
+                # Ещё в очереди — задание снимается, уже идёт — поток остановится на следующей записи
+                stop.set()
+                future.cancel()
+        self.failures[prefix] = 0
+        self.latency.record(prefix, time.perf_counter() - began)
+        return entries
+
+    def _mark_failure(self, prefix: str, reason: str):
+        self.failures[prefix] += 1
+        print(f"Search source {prefix} failed ({reason}), consecutive: {self.failures[prefix]}")
+        if self.failures[prefix] >= SEARCH_SOURCE_MAX_FAILURES:
+            self.disabled_until[prefix] = time.monotonic() + SEARCH_SOURCE_COOLDOWN
+
+    def _extract(self, prefix: str, query: str, max_results: int, cancel_event: Optional[threading.Event] = None,
+                 stop: Optional[threading.Event] = None, on_start: Optional[Callable[[], Any]] = None,
+                 flat: bool = False) -> List[Dict]:
+        if on_start is not None:
+            on_start()
+        yt_dlp = load_yt_dlp()
+        
+        def cancelled() -> bool:
+            return bool((cancel_event and cancel_event.is_set()) or (stop and stop.is_set()))
+        
+        if cancelled():
+            return []
+        # match_filter вызывается на каждую запись выдачи — через него останавливаем поток отменённого
+        # или просроченного поиска
+        def stop_if_cancelled(info, *args, **kwargs):
+            if cancelled():
+                raise yt_dlp.utils.DownloadCancelled('search cancelled')
+            return None
+        opts = dict(self.search_opts, match_filter=stop_if_cancelled)
+        if flat:
+            # Плоская выдача — один запрос страницы поиска без извлечения каждой записи
+            opts['extract_flat'] = 'in_playlist'
+        try:
+            with yt_dlp.YoutubeDL(opts) as ydl:
+                search_results = ydl.extract_info(f"{prefix}{max_results}:{query}", download=False)
+        except yt_dlp.utils.DownloadCancelled:
+            return []
+        
+        if not search_results or 'entries' not in search_results:
+            return []
+        
+        results = []
+        for entry in search_results['entries'][:max_results]:
+            # Хороший результат: есть ссылка и длительность (не стрим); в плоской выдаче ссылка в 'url'
+            url = entry and (entry.get('webpage_url') or (flat and entry.get('url')))
+            if url and entry.get('duration'):
+                results.append({
+                    'title': entry.get('title', 'Unknown'),
+                    'url': url,
+                    'duration_seconds': int(entry.get('duration') or 0),
+                    'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown',
+                    'view_count': entry.get('view_count', 0),
+                    'source': prefix
+                })
+        return results
+
+    def summary(self) -> str:
+        lines = []
+        now = time.monotonic()
+        for prefix, deadline in self.sources:
+            stats = self.latency.report(prefix, top_n=1)
+            p95 = f"{stats[0]['p95']:.1f}s" if stats else "—"
+            status = "⏸️" if self.disabled_until.get(prefix, 0) > now else "✅"
+            lines.append(f"• {prefix}: {status} p95 {p95} / дедлайн {deadline:.0f}s | без потока: {self.queue_timeouts[prefix]}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _merge(collected: List[tuple]) -> List[Dict]:
+        # Дедупликация по нормализованному названию и длительности (±5 сек от первой найденной версии)
+        groups: Dict[str, List[Dict]] = {}
+        for source_rank, position, entry in collected:
+            duration = entry['duration_seconds']
+            same_title = groups.setdefault(normalize_title(entry['title']), [])
+            score = position + source_rank * 0.5
+            current = next((group for group in same_title if abs(group['duration'] - duration) <= 5), None)
+            if current is None:
+                same_title.append({'entry': entry, 'score': score, 'hits': 1, 'duration': duration})
+            else:
+                current['hits'] += 1
+                if score < current['score']:
+                    current['entry'], current['score'] = entry, score
+        ranked = sorted((group for same_title in groups.values() for group in same_title),
+                        key=lambda item: (-item['hits'], item['score']))
+        return [item['entry'] for item in ranked]
+
+# Локальный индекс доставленных треков
+class LocalTrackIndex:
+    """Инвертированный индекс по названиям из таблицы downloads, обновляется инкрементально"""
+
+    def __init__(self):
+        self.tracks: Dict[str, Dict] = {}
+        self.postings: Dict[str, set] = {}
+        self.popularity: Counter = Counter()
+        self.last_id = 0
+        self._sorted_tokens: List[str] = []
+        self._dirty = False
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return [token for token in normalize_title(text).split() if len(token) >= 2]
+
+    def add(self, track: Dict):
+        url = track.get('url')
+        if not url or url in self.tracks:
+            return
+        self.tracks[url] = {
+            'title': track['title'],
+            'url': url,
+            'duration_seconds': int(track.get('duration_seconds') or 0),
+            'uploader': track.get('uploader') or 'Unknown',
+            'view_count': 0,
+            'source': track.get('source'),
+            'local': True
+        }
+        for token in set(self._tokens(f"{track['title']} {track.get('uploader') or ''}")):
+            self.postings.setdefault(token, set()).add(url)
+        self._dirty = True
+
+    def _prefix_matches(self, prefix: str) -> set:
+        if self._dirty:
+            self._sorted_tokens = sorted(self.postings)
+            self._dirty = False
+        matches = set()
+        index = bisect.bisect_left(self._sorted_tokens, prefix)
+        while index < len(self._sorted_tokens) and self._sorted_tokens[index].startswith(prefix):
+            matches |= self.postings[self._sorted_tokens[index]]
+            index += 1
+        return matches
+
+    def search(self, query: str, limit: int) -> List[Dict]:
+        tokens = self._tokens(query)
+        if not tokens:
+            return []
+        
+        # Все слова запроса должны совпасть; последнее — по префиксу (пользователь мог не дописать)
+        candidates = None
+        for position, token in enumerate(tokens):
+            if position == len(tokens) - 1 and len(token) >= 3:
+                matched = self._prefix_matches(token)
+            else:
+                matched = self.postings.get(token, set())
+            candidates = matched if candidates is None else candidates & matched
+            if not candidates:
+                return []
+        
+        ranked = sorted(candidates, key=lambda url: self.popularity[url], reverse=True)
+        return [dict(self.tracks[url]) for url in ranked[:limit]]
+
+    async def refresh(self, database: 'Database'):
+        if not database.available:
+            return
+        while True:
+            async with database.acquire() as conn:
+                rows = await conn.fetch(
+                    '''SELECT id, title, url, source, duration_seconds, uploader FROM downloads
+                       WHERE id > $1 AND url IS NOT NULL
+                       ORDER BY id
+                       LIMIT 5000''',
+                    self.last_id
+                )
+            for row in rows:
+                self.add(dict(row))
+                self.popularity[row['url']] += 1
+                self.last_id = row['id']
+            if len(rows) < 5000:
+                return
+
+local_index = LocalTrackIndex()
+
+async def local_index_refresh_loop():
+    while True:
+        try:
+            await local_index.refresh(db)
+        except Exception as e:
+            print(f"Local index refresh error: {e}")
+        await asyncio.sleep(LOCAL_INDEX_REFRESH_INTERVAL)
+
+# Кэш file_id отправленных треков
+class AudioCache:
+    """file_id уже отправленных треков: повторная доставка без скачивания"""
+
+    def __init__(self, database: 'Database', memory_limit: int = AUDIO_CACHE_MEMORY):
+        self.db = database
+        self.memory_limit = memory_limit
+        self.memory: OrderedDict = OrderedDict()
+
+    def _remember(self, key: tuple, entry: Dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_limit:
+            self.memory.popitem(last=False)
+
+    async def get(self, url: str, bitrate: int = FREE_BITRATE) -> Optional[Dict]:
+        return (await self.get_many([url], bitrate)).get(url)
+
+    async def get_many(self, urls: List[str], bitrate: int = FREE_BITRATE) -> Dict[str, Dict]:
+        found = {}
+        missing = []
+        for url in urls:
+            entry = self.memory.get((url, bitrate))
+            if entry:
+                self.memory.move_to_end((url, bitrate))
+                found[url] = entry
+            else:
+                missing.append(url)
+        
+        if missing and self.db.available:
+            try:
+                async with self.db.acquire() as conn:
+                    rows = await conn.fetch(
+                        'SELECT url, file_id, title, performer FROM track_cache WHERE url = ANY($1) AND bitrate = $2',
+                        missing, bitrate
+                    )
+                for row in rows:
+                    entry = dict(row)
+                    self._remember((row['url'], bitrate), entry)
+                    found[row['url']] = entry
+            except Exception as e:
+                print(f"Audio cache read error: {e}")
+        return found
+
+    async def get_any(self, url: str, preferred: int = FREE_BITRATE) -> Optional[Dict]:
+        # Любой битрейт, ближайший к желаемому сверху вниз
+        for bitrate in sorted(AUDIO_BITRATES, key=lambda b: (b != preferred, -b)):
+            entry = self.memory.get((url, bitrate))
+            if entry:
+                return entry
+        if not self.db.available:
             return None
-        async with self.pool.acquire() as conn:
-            try:
-                row = await conn.fetchrow(
-                    'SELECT * FROM users WHERE user_id = $1', user_id
-                )
-                return dict(row) if row else None
-            except:
-                return None
+        try:
+            async with self.db.acquire() as conn:
+                row = await conn.fetchrow('''
+                    SELECT url, file_id, title, performer FROM track_cache WHERE url = $1
+                    ORDER BY bitrate = $2 DESC, bitrate DESC LIMIT 1
+                ''', url, preferred)
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"Audio cache read error: {e}")
+            return None
+
+    async def put(self, track: Dict, file_id: str, bitrate: int = FREE_BITRATE):
+        entry = {'url': track['url'], 'file_id': file_id, 'title': track['title'], 'performer': track.get('uploader')}
+        self._remember((track['url'], bitrate), entry)
+        if DATABASE_URL:
+            await self.db.write(_store_track_cache, track, file_id, bitrate)
+
+audio_cache = AudioCache(db)
+
+# Прогноз размера до скачивания
+class DeliveryRejected(Exception):
+    """Трек невозможно доставить в пределах лимитов Telegram"""
+
+def predict_mp3_size(duration: float, bitrate: int) -> int:
+    return int(duration * bitrate * 1000 / 8 * MP3_SIZE_OVERHEAD) + MP3_SIZE_RESERVE
+
+def plan_delivery(duration: Optional[float], source_size: Optional[int] = None, tiers: List[int] = AUDIO_BITRATES) -> Dict[int, tuple]:
+    """Для каждого тарифного битрейта: (фактический битрейт, длина части в секундах или None)"""
+    if source_size and source_size > MAX_SOURCE_SIZE:
+        raise DeliveryRejected(f"Исходный файл слишком большой ({source_size // 1024 ** 2} MB)")
+    if not duration:
+        return {tier: (tier, None) for tier in tiers}
+    if duration > MAX_TRACK_DURATION:
+        raise DeliveryRejected(f"Слишком длинная запись ({int(duration) // 60} мин, максимум {MAX_TRACK_DURATION // 60} мин)")
     
-    async def create_user(self, user_id: int, username: str = None, first_name: str = None):
-        if not self.pool:
+    plan = {}
+    for tier in tiers:
+        # Сначала понижаем битрейт, но не ниже FALLBACK_BITRATES; дальше — делим на части
+        candidates = [tier] + [bitrate for bitrate in FALLBACK_BITRATES if bitrate < tier]
+        fitting = next((bitrate for bitrate in candidates if predict_mp3_size(duration, bitrate) <= UPLOAD_LIMIT), None)
+        if fitting:
+            plan[tier] = (fitting, None)
+            continue
+        
+        split_bitrate = min([tier] + list(FALLBACK_BITRATES))
+        segment = int((UPLOAD_LIMIT - MP3_SIZE_RESERVE) / (split_bitrate * 1000 / 8 * MP3_SIZE_OVERHEAD))
+        parts = math.ceil(duration / segment)
+        if parts > MAX_PARTS:
+            raise DeliveryRejected(f"Запись не помещается даже в {MAX_PARTS} частей")
+        plan[tier] = (split_bitrate, segment)
+    return plan
+
+# Общий бюджет пропускной способности для всех загрузок узла
+class BandwidthBudget:
+    """Потокобезопасный token bucket в байтах: потоки загрузки засыпают, когда бюджет исчерпан"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        if not self.rate or amount <= 0:
             return
-        async with self.pool.acquire() as conn:
-            try:
-                await conn.execute('''
-                    INSERT INTO users (user_id, username, first_name) 
-                    VALUES ($1, $2, $3)
-                    ON CONFLICT (user_id) DO UPDATE SET
-                        username = $2,
-                        first_name = $3,
-                        last_activity = NOW()
-                ''', user_id, username, first_name)
-            except:
-                pass
-    
-    async def get_user_stats(self) -> Dict:
-        if not self.pool:
-            return {"total_users": 0, "premium_users": 0, "total_downloads": 0}
-        async with self.pool.acquire() as conn:
-            try:
-                total_users = await conn.fetchval('SELECT COUNT(*) FROM users')
-                premium_users = await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_premium = TRUE')
-                total_downloads = await conn.fetchval('SELECT COUNT(*) FROM downloads')
-                return {
-                    "total_users": total_users or 0,
-                    "premium_users": premium_users or 0,
-                    "total_downloads": total_downloads or 0
-                }
-            except:
-                return {"total_users": 0, "premium_users": 0, "total_downloads": 0}
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.throttled_seconds += wait
+        if wait:
+            time.sleep(min(wait, 5.0))
 
-# Инициализация базы данных
-db = Database()
+# Бюджет узла делится между процессами-воркерами
+bandwidth_budget = BandwidthBudget(NODE_BANDWIDTH_MBIT * 1024 * 1024 / 8 / max(WEB_WORKERS, 1))
 
 # Музыкальный поисковик
 class MusicDownloader:
@@ -206,46 +2066,94 @@ class MusicDownloader:
             'ignoreerrors': True,
         }
         
+        self.variants_root = os.path.join(self.temp_dir, 'music_bot_variants')
+        self.jobs_root = os.path.join(self.temp_dir, 'music_bot_jobs')
+        self.active_workspaces = set()
+        self.stopping = threading.Event()
+        self.transcodes = set()
+        self.pinned: Counter = Counter()
+        # Скачиваем исходную дорожку без перекодирования — MP3 всех битрейтов делает _transcode
         self.download_opts = {
             'format': 'bestaudio[ext=m4a]/bestaudio/best',
             'outtmpl': os.path.join(self.temp_dir, '%(title)s.%(ext)s'),
             'quiet': True,
             'no_warnings': True,
-            'extractaudio': True,
-            'audioformat': 'mp3',
-            'audioquality': '192',
-            'embed_thumbnail': True,
-            'ignoreerrors': True,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
+            'concurrent_fragment_downloads': DOWNLOAD_FRAGMENTS,
+            'retries': 5,
+            'fragment_retries': 5,
+            'continuedl': True,
+            'socket_timeout': 20,
+            'http_chunk_size': 10 * 1024 * 1024,
         }
+        self.engine_stats = Counter()
+        
+        self.search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='search')
+        self.download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+        self.active_downloads = 0
+        self.result_cache: OrderedDict = OrderedDict()
+        self.inflight_searches: Dict[tuple, Dict] = {}
+        self.search_stats = Counter()
+        self.federation = SearchFederation(_parse_search_sources(SEARCH_SOURCES), self.search_opts, self.search_executor)
+    
+    def cached_search(self, query: str, max_results: int) -> Optional[List[Dict]]:
+        entry = self.result_cache.get((normalize_title(query), max_results))
+        if not entry or entry[0] < time.monotonic():
+            return None
+        return [dict(result) for result in entry[1]]
     
-    async def search_music(self, query: str, max_results: int = 5) -> List[Dict]:
+    async def search_music(self, query: str, max_results: int = 5, flat: bool = False) -> List[Dict]:
+        cached = self.cached_search(query, max_results)
+        if cached is not None:
+            return cached
+        
+        # Одинаковые одновременные запросы (чат, inline) разделяют один поиск
+        key = (normalize_title(query), max_results)
+        entry = self.inflight_searches.get(key)
+        if entry is None:
+            cancel_event = threading.Event()
+            task = asyncio.create_task(self._search_uncached(query, max_results, cancel_event, flat))
+            entry = {'task': task, 'cancel': cancel_event, 'waiters': 0}
+            self.inflight_searches[key] = entry
+            task.add_done_callback(
+                lambda done: self.inflight_searches.pop(key, None) if self.inflight_searches.get(key) is entry else None
+            )
+        entry['waiters'] += 1
         try:
-            search_query = f"ytsearch{max_results}:{query}"
-            
-            with yt_dlp.YoutubeDL(self.search_opts) as ydl:
-                search_results = ydl.extract_info(search_query, download=False)
-                
-                if not search_results or 'entries' not in search_results:
-                    return []
-                
-                results = []
-                for entry in search_results['entries'][:max_results]:
-                    if entry:
-                        duration = self._format_duration(entry.get('duration', 0))
-                        results.append({
-                            'title': entry.get('title', 'Unknown'),
-                            'url': entry.get('webpage_url', ''),
-                            'duration': duration,
-                            'uploader': entry.get('uploader', 'Unknown'),
-                            'view_count': entry.get('view_count', 0)
-                        })
-                
-                return results
+            results = await asyncio.shield(entry['task'])
+        finally:
+            entry['waiters'] -= 1
+            # Последний ожидающий отменён: останавливаем и корутину, и потоки yt-dlp
+            if not entry['waiters'] and not entry['task'].done():
+                entry['cancel'].set()
+                entry['task'].cancel()
+                if self.inflight_searches.get(key) is entry:
+                    del self.inflight_searches[key]
+                self.search_stats['cancelled'] += 1
+        return [dict(result) for result in results]
+    
+    async def _search_uncached(self, query: str, max_results: int, cancel_event: Optional[threading.Event] = None,
+                               flat: bool = False) -> List[Dict]:
+        try:
+            # Сначала локальный индекс, удалённый поиск — только чтобы добрать результаты
+            results = local_index.search(query, max_results)
+            if len(results) < max_results:
+                seen = {(normalize_title(r['title']), round(r['duration_seconds'] / 5)) for r in results}
+                seen_urls = {r['url'] for r in results}
+                for remote in await self.federation.search(query, max_results, cancel_event, flat):
+                    key = (normalize_title(remote['title']), round(remote['duration_seconds'] / 5))
+                    if remote['url'] in seen_urls or key in seen:
+                        continue
+                    results.append(remote)
+                    if len(results) >= max_results:
+                        break
+            for result in results:
+                result['duration'] = self._format_duration(result['duration_seconds'])
+            if results:
+                self.result_cache[(normalize_title(query), max_results)] = (time.monotonic() + SEARCH_CACHE_TTL, results)
+                self.result_cache.move_to_end((normalize_title(query), max_results))
+                while len(self.result_cache) > SEARCH_CACHE_SIZE:
+                    self.result_cache.popitem(last=False)
+            return results
         except Exception as e:
             print(f"Search error: {e}")
             return []
@@ -259,37 +2167,477 @@ class MusicDownloader:
             return f"{hours}:{minutes:02d}:{seconds:02d}"
         return f"{minutes}:{seconds:02d}"
     
-    async def download_audio(self, url: str, title: str) -> Optional[str]:
+    async def download_audio(self, url: str, bitrate: int = FREE_BITRATE, cancel_event: Optional[threading.Event] = None,
+                             info: Optional[Dict] = None, executor: Optional[ThreadPoolExecutor] = None) -> List[str]:
+        """Пути к файлам варианта (несколько — если запись разделена на части). DeliveryRejected — до скачивания"""
+        # Вариант нужного битрейта мог остаться от предыдущей доставки — без повторного скачивания
+        existing = self.stored_variant(url, bitrate)
+        if existing:
+            return existing
+        
+        loop = asyncio.get_running_loop()
+        self.active_downloads += 1
         try:
-            sanitized_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).strip()
-            
-            opts = self.download_opts.copy()
-            opts['outtmpl'] = os.path.join(self.temp_dir, f'{sanitized_title}.%(ext)s')
-            
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                expected_file = os.path.join(self.temp_dir, f'{sanitized_title}.mp3')
-                if os.path.exists(expected_file):
-                    return expected_file
-                
-                for file in os.listdir(self.temp_dir):
-                    if file.startswith(sanitized_title) and file.endswith('.mp3'):
-                        return os.path.join(self.temp_dir, file)
-                
-                return None
+            await loop.run_in_executor(
+                executor or self.download_executor, self._download_sync, url, cancel_event, info
+            )
+            return self.stored_variant(url, bitrate)
+        except DeliveryRejected:
+            raise
         except Exception as e:
             print(f"Download error: {e}")
+            return []
+        finally:
+            self.active_downloads -= 1
+    
+    def variant_dir(self, url: str) -> str:
+        return os.path.join(self.variants_root, hashlib.sha1(url.encode()).hexdigest()[:16])
+    
+    def stored_variant(self, url: str, bitrate: int) -> List[str]:
+        target_dir = self.variant_dir(url)
+        single = os.path.join(target_dir, f"{bitrate}.mp3")
+        if os.path.exists(single):
+            return [single]
+        return sorted(glob.glob(os.path.join(target_dir, f"{bitrate}.part*.mp3")))
+    
+    def engine_summary(self) -> str:
+        limit = f"{NODE_BANDWIDTH_MBIT:.0f} Mbit/s" if NODE_BANDWIDTH_MBIT else "без лимита"
+        return (
+            f"• Активных загрузок: {self.active_downloads}/{DOWNLOAD_WORKERS} | фрагментов: {DOWNLOAD_FRAGMENTS}\n"
+            f"• Скачано: {self.engine_stats['bytes'] // 1024 ** 2} MB | бюджет: {limit}, ожидание {bandwidth_budget.throttled_seconds:.0f}s\n"
+            f"• Повторов: {self.engine_stats['retries']} | ошибок: {self.engine_stats['failed']}"
+        )
+    
+    def release_variants(self, url: str) -> bool:
+        # Закреплённые варианты сейчас качаются или отправляются другой доставкой — их потом уберёт уборщик по TTL
+        target_dir = self.variant_dir(url)
+        if self.is_pinned(target_dir):
+            return False
+        shutil.rmtree(target_dir, ignore_errors=True)
+        return True
+    
+    def is_pinned(self, target_dir: str) -> bool:
+        """Закреплён этим процессом или другим живым воркером (маркер .pin-PID в каталоге)"""
+        if target_dir in self.pinned:
+            return True
+        for marker in glob.glob(os.path.join(target_dir, '.pin-*')):
+            try:
+                pid = int(marker.rsplit('-', 1)[1])
+            except ValueError:
+                continue
+            if pid != os.getpid() and _pid_alive(pid):
+                return True
+            # Маркер упавшего процесса больше ничего не защищает
+            with contextlib.suppress(OSError):
+                os.remove(marker)
+        return False
+    
+    @contextlib.contextmanager
+    def pin(self, url: str):
+        # Варианты, которые сейчас отправляются, уборщик не трогает; маркер виден уборщикам других воркеров
+        target_dir = self.variant_dir(url)
+        marker = os.path.join(target_dir, f".pin-{os.getpid()}")
+        if not self.pinned[target_dir]:
+            os.makedirs(target_dir, exist_ok=True)
+            with open(marker, 'w'):
+                pass
+        self.pinned[target_dir] += 1
+        try:
+            yield
+        finally:
+            self.pinned[target_dir] -= 1
+            if self.pinned[target_dir] <= 0:
+                del self.pinned[target_dir]
+                with contextlib.suppress(OSError):
+                    os.remove(marker)
+    
+    def stop(self):
+        """Конец дренажа: незапущенные задачи отменяются, идущие прерываются на ближайшем хуке"""
+        self.stopping.set()
+        for executor in (self.search_executor, self.download_executor):
+            executor.shutdown(wait=False, cancel_futures=True)
+        # ffmpeg не смотрит на хуки yt-dlp: без kill он переживёт дедлайн дренажа и удержит рабочий каталог
+        for process in list(self.transcodes):
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+        for workspace in list(self.active_workspaces):
+            shutil.rmtree(workspace, ignore_errors=True)
+    
+    def janitor(self) -> Dict[str, int]:
+        """Удаляет брошенные рабочие каталоги и держит хранилище вариантов в пределах квоты"""
+        removed = Counter()
+        now = time.time()
+        
+        # Каталоги задач: чужие процессы, которых уже нет, или слишком старые
+        for path in glob.glob(os.path.join(self.jobs_root, 'job-*')):
+            if path in self.active_workspaces:
+                continue
+            try:
+                pid = int(os.path.basename(path).split('-')[1])
+                age = now - os.path.getmtime(path)
+            except (ValueError, IndexError, OSError):
+                continue
+            if pid == os.getpid() or not _pid_alive(pid) or age > JOB_MAX_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+                removed['workspaces'] += 1
+        
+        # Хранилище вариантов: TTL и дисковая квота (сначала самые старые)
+        entries = []
+        for path in glob.glob(os.path.join(self.variants_root, '*')):
+            try:
+                # mtime до проверки закрепления: удаление устаревшего маркера его обновит
+                mtime = os.path.getmtime(path)
+                if self.is_pinned(path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            except OSError:
+                continue
+            if now - mtime > VARIANTS_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+                removed['expired'] += 1
+            else:
+                entries.append((mtime, size, path))
+        
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= VARIANTS_DISK_QUOTA:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed['evicted'] += 1
+        removed['variants_bytes'] = total
+        return removed
+    
+    def _download_sync(self, url: str, cancel_event: Optional[threading.Event], info: Optional[Dict]) -> Dict[int, List[str]]:
+        # Каждая задача работает в своём каталоге: чужие и брошенные файлы не пересекаются
+        os.makedirs(self.jobs_root, exist_ok=True)
+        workspace = tempfile.mkdtemp(prefix=f"job-{os.getpid()}-", dir=self.jobs_root)
+        self.active_workspaces.add(workspace)
+        try:
+            return self._run_job(url, cancel_event, info, workspace)
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+            self.active_workspaces.discard(workspace)
+    
+    def _run_job(self, url: str, cancel_event: Optional[threading.Event], info: Optional[Dict], workspace: str) -> Dict[int, List[str]]:
+        opts = self.download_opts.copy()
+        opts['outtmpl'] = os.path.join(workspace, 'source.%(ext)s')
+        opts['progress_hooks'] = [self._progress_hook(cancel_event)]
+        
+        plan = None
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                with load_yt_dlp().YoutubeDL(opts) as ydl:
+                    # Метаданные извлекаются до скачивания: невозможные задачи отклоняются сразу
+                    if not info:
+                        info = ydl.extract_info(url, download=False)
+                    if not info:
+                        return {}
+                    if plan is None:
+                        plan = plan_delivery(info.get('duration'), info.get('filesize') or info.get('filesize_approx'))
+                    result = ydl.process_ie_result(info, download=True)
+                break
+            except load_yt_dlp().utils.DownloadError as e:
+                # Постоянные ошибки (видео удалено, приватное) не повторяем
+                cause = e.exc_info[1] if e.exc_info else None
+                if attempt == DOWNLOAD_ATTEMPTS or getattr(cause, 'expected', False):
+                    self.engine_stats['failed'] += 1
+                    raise
+                delay = DOWNLOAD_BACKOFF * 2 ** (attempt - 1) + random.uniform(0, 1)
+                self.engine_stats['retries'] += 1
+                print(f"Download attempt {attempt} failed, retry in {delay:.1f}s: {e}")
+                # Ссылки на форматы могли истечь — извлекаем заново, .part докачивается (continuedl)
+                info = None
+                if cancel_event is not None and cancel_event.wait(delay):
+                    raise load_yt_dlp().utils.DownloadCancelled()
+                if cancel_event is None:
+                    time.sleep(delay)
+        
+        # Итоговый путь берём из info yt-dlp, а не поиском по каталогу
+        downloads = (result or {}).get('requested_downloads') or []
+        source_path = downloads[0].get('filepath') if downloads else None
+        if not source_path or not os.path.exists(source_path):
+            return {}
+        
+        outputs = self._transcode(source_path, workspace, plan, cancel_event)
+        return self._publish(url, outputs)
+    
+    def _publish(self, url: str, outputs: Dict[int, List[str]]) -> Dict[int, List[str]]:
+        # Готовые файлы атомарно переносятся в хранилище вариантов
+        target_dir = self.variant_dir(url)
+        os.makedirs(target_dir, exist_ok=True)
+        published = {}
+        for tier, paths in outputs.items():
+            published[tier] = []
+            for path in paths:
+                destination = os.path.join(target_dir, os.path.basename(path))
+                os.replace(path, destination)
+                published[tier].append(destination)
+        return published
+    
+    def _progress_hook(self, cancel_event: Optional[threading.Event]):
+        # Отмена задачи и учёт трафика в общем бюджете узла
+        seen = {}
+        lock = threading.Lock()
+        
+        def hook(status: Dict):
+            if self.stopping.is_set() or (cancel_event is not None and cancel_event.is_set()):
+                raise load_yt_dlp().utils.DownloadCancelled()
+            if status.get('status') != 'downloading':
+                return
+            downloaded = status.get('downloaded_bytes') or 0
+            with lock:
+                key = status.get('filename')
+                delta = downloaded - seen.get(key, 0)
+                seen[key] = downloaded
+            if delta > 0:
+                self.engine_stats['bytes'] += delta
+                bandwidth_budget.consume(delta)
+        
+        return hook
+    
+    def _transcode(self, source_path: str, target_dir: str, plan: Dict[int, tuple], cancel_event: Optional[threading.Event] = None) -> Dict[int, List[str]]:
+        # Один проход ffmpeg: исходник декодируется один раз, каждый уникальный вариант — отдельный выход
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', source_path]
+        patterns = {}
+        for bitrate, segment in sorted(set(plan.values()), key=lambda spec: (spec[0], spec[1] or 0)):
+            name = f"{bitrate}k-{segment}s.part%02d.mp3" if segment else f"{bitrate}k.mp3"
+            patterns[(bitrate, segment)] = os.path.join(target_dir, name)
+            command += ['-map', '0:a:0', '-vn', '-c:a', 'libmp3lame', '-b:a', f'{bitrate}k']
+            if segment:
+                command += ['-f', 'segment', '-segment_time', str(segment), '-reset_timestamps', '1']
+            command.append(patterns[(bitrate, segment)])
+        
+        # Держим handle процесса: отмена задачи или конец дренажа убивают ffmpeg, а не ждут его
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        self.transcodes.add(process)
+        try:
+            while True:
+                try:
+                    _, stderr = process.communicate(timeout=0.5)
+                    break
+                except subprocess.TimeoutExpired:
+                    if self.stopping.is_set() or (cancel_event is not None and cancel_event.is_set()):
+                        process.kill()
+                        process.communicate()
+                        return {}
+        finally:
+            self.transcodes.discard(process)
+        if process.returncode != 0:
+            if not self.stopping.is_set():
+                print(f"Transcode error: {stderr.strip()[-500:]}")
+            return {}
+        
+        # Раскладываем по тарифам: <тариф>.mp3 или <тариф>.partNN.mp3
+        outputs = {}
+        for tier, spec in plan.items():
+            pattern = patterns[spec]
+            produced = sorted(glob.glob(pattern.replace('%02d', '*'))) if spec[1] else [pattern]
+            outputs[tier] = []
+            for number, path in enumerate(produced, 1):
+                destination = os.path.join(target_dir, f"{tier}.part{number:02d}.mp3" if spec[1] else f"{tier}.mp3")
+                os.link(path, destination)
+                outputs[tier].append(destination)
+        for pattern in patterns.values():
+            for path in glob.glob(pattern.replace('%02d', '*')):
+                os.remove(path)
+        return outputs
+    
+    async def extract_url(self, url: str) -> Optional[Dict]:
+        # Плейлист извлекается один раз в плоском виде, треки разрешаются при скачивании
+        loop = asyncio.get_running_loop()
+        opts = dict(self.search_opts, extract_flat='in_playlist', playlistend=PLAYLIST_MAX_TRACKS)
+        
+        def extract():
+            with load_yt_dlp().YoutubeDL(opts) as ydl:
+                return ydl.sanitize_info(ydl.extract_info(url, download=False))
+        
+        try:
+            return await loop.run_in_executor(self.search_executor, extract)
+        except Exception as e:
+            print(f"URL extract error: {e}")
+            return None
+    
+    def track_from_entry(self, entry: Dict) -> Optional[Dict]:
+        url = entry.get('webpage_url') or entry.get('url')
+        if not url or not url.startswith('http'):
+            return None
+        duration_seconds = int(entry.get('duration') or 0)
+        return {
+            'title': entry.get('title') or 'Unknown',
+            'url': url,
+            'duration': self._format_duration(duration_seconds),
+            'duration_seconds': duration_seconds,
+            'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown',
+            'view_count': entry.get('view_count', 0),
+            'source': (entry.get('ie_key') or entry.get('extractor_key') or '').lower() or None
+        }
+    
+    async def resolve(self, url: str, executor: Optional[ThreadPoolExecutor] = None) -> Optional[Dict]:
+        # Только извлечение метаданных и форматов, без скачивания
+        loop = asyncio.get_running_loop()
+        
+        def extract():
+            with load_yt_dlp().YoutubeDL(self.search_opts) as ydl:
+                return ydl.sanitize_info(ydl.extract_info(url, download=False))
+        
+        try:
+            return await loop.run_in_executor(executor or self.download_executor, extract)
+        except Exception as e:
+            print(f"Resolve error: {e}")
             return None
 
 downloader = MusicDownloader()
 
+# Спекулятивная предзагрузка
+def _lower_thread_priority():
+    # Linux: nice для отдельного потока, ffmpeg наследует приоритет
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREFETCH_NICE)
+    except (AttributeError, OSError):
+        pass
+
+class SpeculativePrefetcher:
+    """Пока пользователь выбирает трек, заранее разрешает/скачивает наиболее вероятный"""
+
+    def __init__(self, music_downloader: MusicDownloader):
+        self.downloader = music_downloader
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch', initializer=_lower_thread_priority)
+        self.sessions: Dict[int, Dict] = {}
+        self.pick_positions: Counter = Counter()
+        self.pick_urls: Counter = Counter()
+        self.stats = Counter()
+
+    def choose(self, results: List[Dict]) -> int:
+        # Сначала трек, который чаще всего выбирали, затем самая популярная позиция
+        popular = [i for i, result in enumerate(results) if self.pick_urls[result['url']]]
+        if popular:
+            return max(popular, key=lambda i: self.pick_urls[results[i]['url']])
+        if self.pick_positions:
+            return max(range(len(results)), key=lambda i: self.pick_positions[i])
+        return 0
+
+    def record_pick(self, index: int, url: str):
+        self.pick_positions[index] += 1
+        self.pick_urls[url] += 1
+
+    def schedule(self, user_id: int, results: List[Dict]):
+        self.cancel(user_id)
+        if PREFETCH_MODE == 'off' or not results:
+            return
+        if self.downloader.active_downloads >= DOWNLOAD_WORKERS - 1:
+            self.stats['skipped_busy'] += 1
+            return
+        
+        track = results[self.choose(results)]
+        if track.get('duration_seconds', 0) > PREFETCH_MAX_DURATION:
+            return
+        
+        # Поток предзагрузки один: очередь держим короткой, вытесняя самые старые сессии
+        while len(self.sessions) >= PREFETCH_MAX_SESSIONS:
+            self.cancel(next(iter(self.sessions)))
+            self.stats['evicted'] += 1
+        
+        session = {'url': track['url'], 'cancel': threading.Event()}
+        session['task'] = asyncio.create_task(self._run(track, session['cancel']))
+        session['timer'] = asyncio.get_running_loop().call_later(PREFETCH_TTL, self.cancel, user_id)
+        self.sessions[user_id] = session
+        self.stats['started'] += 1
+
+    async def _run(self, track: Dict, cancel_event: threading.Event) -> Optional[Dict]:
+        if await audio_cache.get(track['url']):
+            return None
+        info = await self.downloader.resolve(track['url'], executor=self.executor)
+        if info is None or cancel_event.is_set() or PREFETCH_MODE != 'download':
+            return {'info': info, 'paths': []} if info else None
+        
+        try:
+            paths = await self.downloader.download_audio(
+                track['url'], cancel_event=cancel_event, info=info, executor=self.executor
+            )
+        except DeliveryRejected:
+            return None
+        if cancel_event.is_set():
+            # Пользователь выбрал другой трек или сессия истекла
+            self.downloader.release_variants(track['url'])
+            return None
+        return {'info': info, 'paths': paths}
+
+    def cancel(self, user_id: int):
+        session = self.sessions.pop(user_id, None)
+        if not session:
+            return
+        session['timer'].cancel()
+        session['cancel'].set()
+        # Отмена задачи снимает ещё не начатое задание с очереди потока предзагрузки
+        session['task'].cancel()
+        self.stats['cancelled'] += 1
+
+    async def take(self, user_id: int, track: Dict) -> Optional[Dict]:
+        session = self.sessions.get(user_id)
+        if not session or session['url'] != track['url']:
+            self.stats['miss'] += 1
+            self.cancel(user_id)
+            return None
+        
+        # Незавершённую предзагрузку не ждём: обычная загрузка не встанет в очередь за чужой работой
+        if not session['task'].done():
+            self.stats['not_ready'] += 1
+            self.cancel(user_id)
+            return None
+        
+        self.sessions.pop(user_id)
+        session['timer'].cancel()
+        if session['task'].cancelled() or session['task'].exception():
+            self.stats['miss'] += 1
+            return None
+        self.stats['hit'] += 1
+        return session['task'].result()
+
+    def summary(self) -> str:
+        return (
+            f"• Режим: {PREFETCH_MODE} | запущено: {self.stats['started']}\n"
+            f"• Попаданий: {self.stats['hit']} | промахов: {self.stats['miss']} | не готово: {self.stats['not_ready']}\n"
+            f"• Отменено: {self.stats['cancelled']} | вытеснено: {self.stats['evicted']}"
+        )
+
+prefetcher = SpeculativePrefetcher(downloader)
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+async def janitor_loop():
+    while True:
+        try:
+            removed = await asyncio.get_running_loop().run_in_executor(None, downloader.janitor)
+            if removed['workspaces'] or removed['expired'] or removed['evicted']:
+                print(f"Janitor: workspaces {removed['workspaces']}, expired {removed['expired']}, "
+                      f"evicted {removed['evicted']}, variants {removed['variants_bytes'] // 1024 ** 2} MB")
+        except Exception as e:
+            print(f"Janitor error: {e}")
+        await asyncio.sleep(JANITOR_INTERVAL)
+
 # Функции для языка
 def get_user_language(user_id: int) -> str:
     return user_languages.get(user_id, 'ru')
 
-def set_user_language(user_id: int, lang: str):
+async def set_user_language(user_id: int, lang: str):
     user_languages[user_id] = lang
+    await db.set_language(user_id, lang)
+
+async def load_user_language(user_id: int):
+    # Язык хранится в users.language_code; в многопроцессном режиме перечитываем каждый раз
+    if user_id in user_languages and not shared_state.is_shared:
+        return
+    lang = await db.get_language(user_id)
+    if lang in TEXTS:
+        user_languages[user_id] = lang
 
 # Тексты интерфейса
 TEXTS = {
@@ -391,21 +2739,259 @@ def create_admin_keyboard() -> ReplyKeyboardMarkup:
         input_field_placeholder="Выберите админскую функцию..."
     )
 
-def create_search_results_keyboard(results: List[Dict], user_id: int) -> InlineKeyboardMarkup:
+def create_search_results_keyboard(results: List[Dict], user_id: int, favorite_urls: Optional[set] = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    favorite_urls = favorite_urls or set()
     
     for i, result in enumerate(results):
         title = result['title'][:50] + "..." if len(result['title']) > 50 else result['title']
-        builder.button(
-            text=f"🎵 {title} ({result['duration']})",
-            callback_data=f"download:{i}"
+        builder.row(
+            InlineKeyboardButton(text=f"🎵 {title} ({result['duration']})", callback_data=f"download:{i}"),
+            InlineKeyboardButton(text="❤️" if result['url'] in favorite_urls else "🤍", callback_data=f"fav:{i}")
         )
     
-    builder.button(text=get_text(user_id, 'back'), callback_data="back_to_menu")
-    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text=get_text(user_id, 'back'), callback_data="back_to_menu"))
     
     return builder.as_markup()
 
+# Замер времени хендлеров и кнопок
+_button_labels = None
+
+def _known_buttons() -> set:
+    global _button_labels
+    if _button_labels is None:
+        labels = set()
+        for keyboard in (create_main_keyboard(ADMIN_ID), create_admin_keyboard()):
+            for row in keyboard.keyboard:
+                labels.update(button.text for button in row)
+        _button_labels = labels
+    return _button_labels
+
+def _event_key(event: TelegramObject) -> str:
+    if isinstance(event, Message):
+        text = event.text or ''
+        if text.startswith('/'):
+            return f"command:{text.split()[0]}"
+        if text in _known_buttons():
+            return f"button:{text}"
+        return "button:<поиск>"
+    if isinstance(event, CallbackQuery):
+        return f"callback:{(event.data or '').split(':')[0]}"
+    if isinstance(event, InlineQuery):
+        return "inline:query"
+    return f"event:{type(event).__name__}"
+
+# Допуск к поиску и скачиванию: token bucket на пользователя и общий на процесс
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+class AdmissionController:
+    def __init__(self):
+        # Общая ёмкость узла делится между процессами-воркерами
+        workers = max(WEB_WORKERS, 1)
+        self.global_buckets = {
+            kind: TokenBucket(rate / workers, max(1.0, burst / workers))
+            for kind, (rate, burst) in ADMISSION_GLOBAL_LIMITS.items()
+        }
+        self.user_buckets: OrderedDict = OrderedDict()
+        self.premium: Dict[int, tuple] = {}
+        self.last_notice: Dict[int, float] = {}
+        self.stats = Counter()
+
+    async def is_premium(self, user_id: int) -> bool:
+        cached = self.premium.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        user_data = await db.get_user(user_id)
+        premium = bool(user_data and user_data.get('is_premium'))
+        self.premium[user_id] = (premium, time.monotonic() + ADMISSION_PREMIUM_TTL)
+        return premium
+
+    def _user_bucket(self, user_id: int, kind: str, premium: bool) -> TokenBucket:
+        key = (user_id, kind, premium)
+        bucket = self.user_buckets.get(key)
+        if bucket is None:
+            per_minute, burst = ADMISSION_USER_LIMITS[(kind, premium)]
+            bucket = self.user_buckets[key] = TokenBucket(per_minute / 60, burst)
+            # Полные корзины без активности ничего не помнят — их можно выбросить
+            while len(self.user_buckets) > 10000:
+                oldest_key, oldest = next(iter(self.user_buckets.items()))
+                self.user_buckets.pop(oldest_key)
+                if not oldest.idle:
+                    self.user_buckets[oldest_key] = oldest
+                    break
+        self.user_buckets.move_to_end(key)
+        return bucket
+
+    async def admit(self, user_id: int, kind: str) -> Optional[str]:
+        """None — допущено, иначе текст отказа"""
+        if user_id == ADMIN_ID:
+            return None
+        premium = await self.is_premium(user_id)
+        bucket = self._user_bucket(user_id, kind, premium)
+        if not bucket.try_take():
+            self.stats[f'rejected_user:{kind}'] += 1
+            return f"⏳ Слишком часто. Повторите через {math.ceil(bucket.wait_time())} сек"
+        global_bucket = self.global_buckets[kind]
+        if not global_bucket.try_take():
+            bucket.refund()
+            self.stats[f'rejected_global:{kind}'] += 1
+            return f"🚦 Сервер перегружен. Повторите через {math.ceil(global_bucket.wait_time())} сек"
+        self.stats[f'admitted:{kind}'] += 1
+        return None
+
+    async def acquire(self, user_id: int, kind: str):
+        """Ждёт токен вместо отказа — для работы внутри уже допущенного запроса (треки плейлиста)"""
+        if user_id == ADMIN_ID:
+            return
+        premium = await self.is_premium(user_id)
+        paced = False
+        while True:
+            bucket = self._user_bucket(user_id, kind, premium)
+            global_bucket = self.global_buckets[kind]
+            if bucket.try_take():
+                if global_bucket.try_take():
+                    self.stats[f'admitted:{kind}'] += 1
+                    return
+                bucket.refund()
+            if not paced:
+                paced = True
+                self.stats[f'paced:{kind}'] += 1
+            await asyncio.sleep(max(bucket.wait_time(), global_bucket.wait_time(), 0.1))
+
+    def should_notify(self, user_id: int) -> bool:
+        # Отказ флудеру отправляем не чаще раза в ADMISSION_NOTICE_INTERVAL, остальные молча отбрасываем
+        now = time.monotonic()
+        if now - self.last_notice.get(user_id, 0) < ADMISSION_NOTICE_INTERVAL:
+            return False
+        self.last_notice[user_id] = now
+        if len(self.last_notice) > 10000:
+            self.last_notice = {uid: at for uid, at in self.last_notice.items() if now - at < ADMISSION_NOTICE_INTERVAL}
+        return True
+
+    def counters(self) -> Dict[str, int]:
+        return dict(self.stats)
+
+    def summary(self, counters: Optional[Dict[str, int]] = None) -> str:
+        stats = Counter(counters if counters is not None else self.stats)
+        lines = []
+        for kind in ADMISSION_GLOBAL_LIMITS:
+            lines.append(
+                f"• {kind}: допущено {stats[f'admitted:{kind}']} | "
+                f"лимит пользователя {stats[f'rejected_user:{kind}']} | "
+                f"перегрузка {stats[f'rejected_global:{kind}']} | в темпе лимита {stats[f'paced:{kind}']}"
+            )
+        return "\n".join(lines)
+
+admission = AdmissionController()
+
+def _admission_kind(event: TelegramObject) -> Optional[str]:
+    # Дорогая работа: поиск (свободный текст) и скачивание (кнопка трека, ссылка).
+    # Inline-запрос приходит на каждое нажатие клавиши — его списывает answer_inline_query после debounce
+    if isinstance(event, Message):
+        text = (event.text or '').strip()
+        if not text or text.startswith('/') or text in _known_buttons():
+            return None
+        return 'download' if re.match(r'https?://\S+$', text) else 'search'
+    if isinstance(event, CallbackQuery):
+        return 'download' if (event.data or '').startswith('download:') else None
+    return None
+
+class AdmissionMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        kind = _admission_kind(event)
+        user = data.get('event_from_user')
+        if not kind or not user:
+            return await handler(event, data)
+        
+        # Во время дренажа новую тяжёлую работу не начинаем
+        if update_queue.draining:
+            rejection = "🔄 Бот перезапускается, повторите запрос через минуту"
+        else:
+            rejection = await admission.admit(user.id, kind)
+        if rejection is None:
+            return await handler(event, data)
+        
+        # Отказ стоит одного короткого ответа без обращения к поиску и загрузчику
+        if isinstance(event, CallbackQuery):
+            await event.answer(rejection)
+        elif admission.should_notify(user.id):
+            await event.answer(rejection)
+        return None
+
+class TimingMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_object = data.get('handler')
+            name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+            key = _event_key(event)
+            timings.record(f"handler:{name}", elapsed)
+            timings.record(key, elapsed)
+            if elapsed > SLOW_HANDLER_THRESHOLD:
+                print(f"Slow handler {name} ({key}) {elapsed:.2f}s")
+
+class UserStateMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user:
+            await load_user_language(user.id)
+        return await handler(event, data)
+
+dp.message.middleware(TimingMiddleware())
+dp.callback_query.middleware(TimingMiddleware())
+dp.inline_query.middleware(TimingMiddleware())
+dp.message.middleware(AdmissionMiddleware())
+dp.callback_query.middleware(AdmissionMiddleware())
+dp.message.middleware(UserStateMiddleware())
+dp.callback_query.middleware(UserStateMiddleware())
+
 # Обработчики команд
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
@@ -439,7 +3025,8 @@ async def cmd_premium_add(message: Message):
         target_user_id = int(parts[1])
         
         # Добавляем премиум в базу данных
-        async with db.pool.acquire() as conn:
+        admission.premium.pop(target_user_id, None)
+        async with db.acquire() as conn:
             await conn.execute(
                 "UPDATE users SET is_premium = TRUE WHERE user_id = $1",
                 target_user_id
@@ -492,7 +3079,8 @@ async def cmd_premium_remove(message: Message):
         target_user_id = int(parts[1])
         
         # Убираем премиум в базе данных
-        async with db.pool.acquire() as conn:
+        admission.premium.pop(target_user_id, None)
+        async with db.acquire() as conn:
             result = await conn.fetchrow(
                 "UPDATE users SET is_premium = FALSE WHERE user_id = $1 RETURNING username, first_name",
                 target_user_id
@@ -531,7 +3119,7 @@ async def cmd_user_info(message: Message):
         target_user_id = int(parts[1])
         
         # Получаем информацию о пользователе
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             user = await conn.fetchrow(
                 "SELECT * FROM users WHERE user_id = $1",
                 target_user_id
@@ -542,10 +3130,7 @@ async def cmd_user_info(message: Message):
                 created_at = user['created_at'].strftime("%d.%m.%Y %H:%M") if user['created_at'] else "Неизвестно"
                 
                 # Получаем статистику скачиваний
-                downloads_count = await conn.fetchval(
-                    "SELECT COUNT(*) FROM downloads WHERE user_id = $1",
-                    target_user_id
-                ) or 0
+                downloads_count = user['total_downloads'] or 0
                 
                 response = f"""👤 ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ
                 
@@ -571,41 +3156,83 @@ async def cmd_user_list(message: Message):
         await message.answer("❌ Команда доступна только администратору")
         return
     
-    try:
-        async with db.pool.acquire() as conn:
-            users = await conn.fetch(
-                '''SELECT user_id, username, first_name, is_premium, created_at 
-                   FROM users 
-                   ORDER BY created_at DESC 
-                   LIMIT 50'''
-            )
-        
-        if not users:
-            await message.answer("📋 Пользователи не найдены")
-            return
-        
-        users_text = "📋 СПИСОК ПОЛЬЗОВАТЕЛЕЙ (последние 50):\n\n"
-        
-        for i, user in enumerate(users, 1):
-            premium_mark = "💎" if user['is_premium'] else "👤"
-            username = f"@{user['username']}" if user['username'] else "—"
-            name = user['first_name'] or "Без имени"
-            date = user['created_at'].strftime("%d.%m") if user['created_at'] else "???"
-            
-            users_text += f"{i}. {premium_mark} ID: {user['user_id']}\n"
-            users_text += f"   📝 {name} | {username} | {date}\n\n"
-        
-        # Разбиваем на части если слишком длинное
-        if len(users_text) > 4000:
-            parts = [users_text[i:i+4000] for i in range(0, len(users_text), 4000)]
-            for part in parts:
-                await message.answer(part)
-        else:
-            await message.answer(users_text)
+    # /user_list [premium] [ДНЕЙ] — только премиум и/или активные за последние N дней
+    args = message.text.split()[1:]
+    premium_only = 'premium' in args
+    active_days = next((int(arg) for arg in args if arg.isdigit()), 0)
     
+    try:
+        text, keyboard = await render_user_page(premium_only, active_days)
+        await message.answer(text, reply_markup=keyboard)
     except Exception as e:
         await message.answer(f"❌ Ошибка получения списка: {str(e)}")
 
+async def fetch_user_page(premium_only: bool, active_days: int, cursor: Optional[tuple] = None, newer: bool = False) -> tuple:
+    # Keyset-пагинация по (created_at, user_id): каждая страница — один проход по индексу
+    conditions = ['created_at IS NOT NULL']
+    params = []
+    if premium_only:
+        conditions.append('is_premium = TRUE')
+    if active_days:
+        params.append(active_days)
+        conditions.append(f'last_activity >= NOW() - make_interval(days => ${len(params)})')
+    if cursor:
+        params.extend(cursor)
+        operator = '>' if newer else '<'
+        conditions.append(f'(created_at, user_id) {operator} (${len(params) - 1}, ${len(params)})')
+    order = 'ASC' if newer else 'DESC'
+    where = f"WHERE {' AND '.join(conditions)}"
+    params.append(USER_LIST_PAGE_SIZE + 1)
+    
+    async with db.acquire() as conn:
+        rows = await conn.fetch(f'''
+            SELECT user_id, username, first_name, is_premium, created_at
+            FROM users {where}
+            ORDER BY created_at {order}, user_id {order}
+            LIMIT ${len(params)}
+        ''', *params)
+    
+    has_more = len(rows) > USER_LIST_PAGE_SIZE
+    rows = rows[:USER_LIST_PAGE_SIZE]
+    if newer:
+        rows.reverse()
+    return rows, has_more
+
+def _user_cursor(user) -> str:
+    return f"{user['created_at'].strftime('%Y%m%d%H%M%S%f')}:{user['user_id']}"
+
+async def render_user_page(premium_only: bool, active_days: int, cursor: Optional[tuple] = None, newer: bool = False) -> tuple:
+    users, has_more = await fetch_user_page(premium_only, active_days, cursor, newer)
+    
+    filters = []
+    if premium_only:
+        filters.append("💎 премиум")
+    if active_days:
+        filters.append(f"активны за {active_days} дн.")
+    users_text = f"📋 СПИСОК ПОЛЬЗОВАТЕЛЕЙ{' (' + ', '.join(filters) + ')' if filters else ''}:\n\n"
+    if not users:
+        return users_text + "Пользователи не найдены", None
+    
+    for user in users:
+        premium_mark = "💎" if user['is_premium'] else "👤"
+        username = f"@{user['username']}" if user['username'] else "—"
+        name = user['first_name'] or "Без имени"
+        date = user['created_at'].strftime("%d.%m.%Y")
+        
+        users_text += f"{premium_mark} ID: {user['user_id']}\n"
+        users_text += f"   📝 {name} | {username} | {date}\n"
+    
+    # Назад — к более новым, вперёд — к более старым пользователям
+    has_newer = has_more if newer else cursor is not None
+    has_older = True if newer else has_more
+    prefix = f"ul:{int(premium_only)}:{active_days}"
+    builder = InlineKeyboardBuilder()
+    if has_newer:
+        builder.button(text="⬅️ Новее", callback_data=f"{prefix}:p:{_user_cursor(users[0])}")
+    if has_older:
+        builder.button(text="Старше ➡️", callback_data=f"{prefix}:n:{_user_cursor(users[-1])}")
+    return users_text, builder.as_markup() if has_newer or has_older else None
+
 @dp.message(Command("broadcast_all"))
 async def cmd_broadcast_all(message: Message):
     if message.from_user.id != ADMIN_ID:
@@ -622,7 +3249,7 @@ async def cmd_broadcast_all(message: Message):
         broadcast_text = parts[1]
         
         # Получаем всех пользователей
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             users = await conn.fetch("SELECT user_id FROM users")
         
         if not users:
@@ -662,7 +3289,7 @@ async def cmd_broadcast_premium(message: Message):
         
         broadcast_text = parts[1]
         
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             users = await conn.fetch("SELECT user_id FROM users WHERE is_premium = TRUE")
         
         if not users:
@@ -701,7 +3328,7 @@ async def cmd_broadcast_active(message: Message):
         
         broadcast_text = parts[1]
         
-        async with db.pool.acquire() as conn:
+        async with db.acquire() as conn:
             users = await conn.fetch(
                 "SELECT user_id FROM users WHERE created_at >= NOW() - INTERVAL '7 days'"
             )
@@ -728,6 +3355,87 @@ async def cmd_broadcast_active(message: Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка рассылки: {str(e)}")
 
+def _format_timings(title: str, rows: List[Dict]) -> str:
+    lines = [title]
+    if not rows:
+        lines.append("• нет данных")
+    for row in rows:
+        lines.append(
+            f"• {row['key']}\n"
+            f"   n={row['count']} avg={row['avg'] * 1000:.0f}ms "
+            f"p95={row['p95'] * 1000:.0f}ms max={row['max'] * 1000:.0f}ms"
+        )
+    return "\n".join(lines)
+
+@dp.message(Command("startup"))
+async def cmd_startup(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Команда доступна только администратору")
+        return
+    
+    await message.answer(f"⏱️ ХОЛОДНЫЙ СТАРТ (воркер {WORKER_INDEX})\n\n{startup.report()}")
+
+@dp.message(Command("timings"))
+async def cmd_timings(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Команда доступна только администратору")
+        return
+    
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == 'reset':
+        timings.reset()
+        write_metrics_snapshot()
+        scope = f" (воркер {WORKER_INDEX})" if WEB_WORKERS > 1 else ""
+        await message.answer(f"✅ Статистика времени сброшена{scope}")
+        return
+    
+    # Сводка по всем воркерам из их снимков метрик
+    merged = aggregate_metrics()['timings']
+    sections = [
+        _format_timings("⏱️ ХЕНДЛЕРЫ:", timing_rows(merged, 'handler:')),
+        _format_timings("🔘 КНОПКИ И КОМАНДЫ:", timing_rows(merged, 'button:') + timing_rows(merged, 'command:') + timing_rows(merged, 'callback:')),
+        _format_timings("🗄️ SQL ЗАПРОСЫ:", timing_rows(merged, 'sql:')),
+    ]
+    for section in sections:
+        await message.answer(section[:4000])
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Команда доступна только администратору")
+        return
+    
+    try:
+        parts = message.text.split()
+        seconds = int(parts[1]) if len(parts) > 1 else 10
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+            await message.answer(f"❌ Длительность от 1 до {PROFILE_MAX_SECONDS} секунд")
+            return
+        
+        if profiler.running:
+            await message.answer("⚠️ Профилирование уже запущено")
+            return
+        
+        await message.answer(f"🔬 Профилирование запущено на {seconds} сек...")
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+        
+        await message.answer(f"🔬 ПРОФИЛЬ ЗА {seconds} СЕК\n\n{profiler.top()}"[:4000])
+        if profiler.stacks:
+            document = BufferedInputFile(
+                profiler.folded().encode(),
+                filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"
+            )
+            await message.answer_document(document, caption="🔥 Folded stacks для flamegraph.pl / speedscope.app")
+    
+    except ValueError:
+        await message.answer("❌ Использование: /profile СЕКУНДЫ")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка профилирования: {str(e)}")
+
 @dp.message()
 async def handle_message(message: Message):
     user_stats['messages'] += 1
@@ -747,13 +3455,14 @@ async def handle_message(message: Message):
             return
         elif text == "📊 Статистика пользователей":
             stats = await db.get_user_stats()
+            metrics = aggregate_metrics()
             uptime = datetime.now() - start_time
             response = f"""📊 СТАТИСТИКА СИСТЕМЫ
 
 👥 Всего пользователей: {stats['total_users']}
 💎 Премиум пользователей: {stats['premium_users']}
 ⬇️ Всего скачиваний: {stats['total_downloads']}
-💬 Сообщений за сессию: {user_stats['messages']}
+💬 Сообщений за сессию: {metrics['messages']}
 ⏰ Время работы: {uptime}
 🛡️ Статус: Полнофункциональный бот активен"""
             await message.answer(response, reply_markup=create_admin_keyboard())
@@ -780,49 +3489,53 @@ async def handle_message(message: Message):
                 import psutil
                 import requests
                 
-                # Проверка HTTP сервера
-                try:
-                    response_check = requests.get('http://localhost:5000', timeout=5)
-                    http_status = "✅ Активен" if response_check.status_code == 200 else "❌ Ошибка"
-                    uptime_info = response_check.json().get('uptime', 'Неизвестно')
-                except:
-                    http_status = "❌ Недоступен"
-                    uptime_info = "Неизвестно"
+                def collect_system():
+                    # Блокирующие проверки (HTTP, замер CPU, обход процессов) — в пуле потоков, не в event loop
+                    try:
+                        response_check = requests.get(f"http://localhost:{os.environ.get('PORT', 5000)}", timeout=5)
+                        http_status = "✅ Активен" if response_check.status_code == 200 else "❌ Ошибка"
+                        uptime_info = response_check.json().get('uptime', 'Неизвестно')
+                    except:
+                        http_status = "❌ Недоступен"
+                        uptime_info = "Неизвестно"
+                    
+                    # Проверка процессов защиты
+                    protection_processes = {
+                        'MECHANICAL BOT': False,
+                        'MINIMAL KEEPALIVE': False,
+                        'BACKUP SERVER': False,
+                        'MONITORING SYSTEM': False
+                    }
+                    
+                    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+                        try:
+                            cmdline = ' '.join(proc.info['cmdline'] or [])
+                            if 'FULL_MUSIC_BOT.py' in cmdline:
+                                protection_processes['MECHANICAL BOT'] = True
+                            elif 'MINIMAL_KEEPALIVE.py' in cmdline:
+                                protection_processes['MINIMAL KEEPALIVE'] = True
+                            elif 'BACKUP_SERVER.py' in cmdline:
+                                protection_processes['BACKUP SERVER'] = True
+                            elif 'MONITORING_SYSTEM.py' in cmdline:
+                                protection_processes['MONITORING SYSTEM'] = True
+                        except:
+                            continue
+                    
+                    return (http_status, uptime_info, psutil.cpu_percent(interval=1), psutil.virtual_memory(),
+                            psutil.disk_usage('/'), protection_processes)
+                
+                system_check = asyncio.get_running_loop().run_in_executor(None, collect_system)
                 
                 # Проверка базы данных
                 try:
-                    async with db.pool.acquire() as conn:
+                    async with db.acquire() as conn:
                         await conn.fetchval('SELECT 1')
                     db_status = "✅ Подключена"
                 except:
                     db_status = "❌ Ошибка подключения"
                 
-                # Системные метрики
-                cpu_percent = psutil.cpu_percent(interval=1)
-                memory = psutil.virtual_memory()
-                disk = psutil.disk_usage('/')
-                
-                # Проверка процессов защиты
-                protection_processes = {
-                    'MECHANICAL BOT': False,
-                    'MINIMAL KEEPALIVE': False,
-                    'BACKUP SERVER': False,
-                    'MONITORING SYSTEM': False
-                }
-                
-                for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-                    try:
-                        cmdline = ' '.join(proc.info['cmdline'] or [])
-                        if 'FULL_MUSIC_BOT.py' in cmdline:
-                            protection_processes['MECHANICAL BOT'] = True
-                        elif 'MINIMAL_KEEPALIVE.py' in cmdline:
-                            protection_processes['MINIMAL KEEPALIVE'] = True
-                        elif 'BACKUP_SERVER.py' in cmdline:
-                            protection_processes['BACKUP SERVER'] = True
-                        elif 'MONITORING_SYSTEM.py' in cmdline:
-                            protection_processes['MONITORING SYSTEM'] = True
-                    except:
-                        continue
+                http_status, uptime_info, cpu_percent, memory, disk, protection_processes = await system_check
+                metrics = aggregate_metrics()
                 
                 # Формируем статус процессов
                 processes_status = []
@@ -837,7 +3550,9 @@ async def handle_message(message: Message):
 🔍 Статус серверов:
 • HTTP сервер: {http_status}
 • База данных: {db_status}
+• Bot API: {TELEGRAM_API_URL or 'api.telegram.org'}{' (local)' if TELEGRAM_API_LOCAL else ''}
 • Uptime: {uptime_info}
+• Воркеров: {metrics['workers']}
 
 📊 Системные метрики:
 • CPU: {cpu_percent:.1f}%
@@ -845,6 +3560,28 @@ async def handle_message(message: Message):
 • Disk: {disk.percent:.1f}%
 • Свободно RAM: {memory.available // (1024**3):.1f}GB
 
+🗄️ База данных:
+{db.summary()}
+
+🚦 Допуск к поиску и загрузкам:
+{admission.summary(metrics['admission'])}
+
+⏳ Задержка event loop:
+{loop_lag_summary(metrics['loop_lag'])}
+
+📥 Очередь обновлений:
+{update_queue.summary(metrics['queue'])}
+
+🔎 Источники поиска:
+{downloader.federation.summary()}
+• Заменено новыми запросами: {downloader.search_stats['superseded']} | остановлено поисков: {downloader.search_stats['cancelled']}
+
+🚀 Предзагрузка:
+{prefetcher.summary()}
+
+⬇️ Движок загрузок:
+{downloader.engine_summary()}
+
 🛡️ Защитные процессы:
 {chr(10).join(processes_status)}
 
@@ -862,38 +3599,77 @@ async def handle_message(message: Message):
             return
         
         elif text == "📈 Аналитика системы":
+            import psutil
+            await rollups.flush()
             stats = await db.get_user_stats()
+            metrics = aggregate_metrics()
             uptime = datetime.now() - start_time
+            now = datetime.now()
+            
+            hourly = await rollups.fetch('hourly', now - timedelta(hours=24))
+            daily = await rollups.fetch('daily', now - timedelta(days=6))
+            
+            def bound_text(value: float) -> str:
+                # Последняя корзина не ограничена сверху: известно только, что дольше последней границы
+                return f">{LATENCY_BUCKETS[-1]:g}s" if math.isinf(value) else f"≤{value:g}s"
+            
+            def latency_text(histogram) -> str:
+                p50 = histogram_percentile(histogram or [], 0.5)
+                p95 = histogram_percentile(histogram or [], 0.95)
+                if p50 is None:
+                    return "—"
+                return f"p50{bound_text(p50)} p95{bound_text(p95)}"
+            
+            day_histogram = [sum(values) for values in zip(*[row['latency_histogram'] or [] for row in hourly])]
+            day_downloads = sum(row['downloads'] for row in hourly)
+            day_failures = sum(row['failures'] for row in hourly)
+            day_lines = []
+            for row in daily:
+                average = row['duration_seconds'] // row['downloads'] if row['downloads'] else 0
+                day_lines.append(
+                    f"• {row['bucket'].strftime('%d.%m')}: ⬇️ {row['downloads']} | 👥 {row['unique_users']} | "
+                    f"❌ {row['failures']} | ⏱ {average // 60}:{average % 60:02d} | {latency_text(row['latency_histogram'])}"
+                )
+            
             response = f"""📈 АНАЛИТИКА СИСТЕМЫ
 
 👥 Всего пользователей: {stats['total_users']}
 💎 Премиум пользователей: {stats['premium_users']}
 ⬇️ Всего скачиваний: {stats['total_downloads']}
-💬 Сообщений за сессию: {user_stats['messages']}
-👥 Активных за сессию: {len(user_stats['users'])}
+💬 Сообщений за сессию: {metrics['messages']}
+👥 Активных за сессию: {len(metrics['users'])}
+⚙️ Воркеров: {metrics['workers']}
 ⏰ Время работы: {uptime}
-📊 Средняя загрузка CPU: 45%
-🔄 Состояние: Стабильное"""
+📊 Загрузка CPU: {psutil.cpu_percent()}%
+
+🕐 За 24 часа:
+• Скачиваний: {day_downloads} | ошибок: {day_failures}
+• Задержка доставки: {latency_text(day_histogram)}
+
+📅 По дням:
+{chr(10).join(day_lines) if day_lines else '• нет данных'}"""
             await message.answer(response, reply_markup=create_admin_keyboard())
             return
         
         elif text == "💾 Экспорт данных":
-            response = """💾 ЭКСПОРТ ДАННЫХ
+            if not db.available:
+                await message.answer("❌ База данных недоступна", reply_markup=create_admin_keyboard())
+                return
+            response = f"""💾 ЭКСПОРТ ДАННЫХ
 
-📊 Доступные форматы:
-• CSV - пользователи и статистика
-• JSON - полная база данных
-• TXT - логи системы
+📊 Форматы:
+• CSV - с заголовком
+• JSON - по объекту на строку (JSON Lines)
 
-🔄 Экспорт выполняется...
-📁 Файлы будут отправлены в личные сообщения"""
-            await message.answer(response, reply_markup=create_admin_keyboard())
+📦 Файлы приходят частями .gz по ~{EXPORT_CHUNK_SIZE // (1024 * 1024)} MB по мере выгрузки
+🔄 Активных экспортов: {len(export_tasks)}"""
+            await message.answer(response, reply_markup=create_export_keyboard())
             return
         
         elif text == "📢 Рассылка":
             try:
                 # Получаем статистику пользователей
-                async with db.pool.acquire() as conn:
+                async with db.acquire() as conn:
                     total_users = await conn.fetchval('SELECT COUNT(*) FROM users')
                     premium_users = await conn.fetchval('SELECT COUNT(*) FROM users WHERE is_premium = TRUE')
                     active_users = await conn.fetchval(
@@ -923,7 +3699,7 @@ async def handle_message(message: Message):
         elif text == "👥 Управление пользователями":
             try:
                 # Получаем список последних пользователей с их ID
-                async with db.pool.acquire() as conn:
+                async with db.acquire() as conn:
                     recent_users = await conn.fetch(
                         '''SELECT user_id, username, first_name, is_premium, created_at 
                            FROM users 
@@ -952,7 +3728,7 @@ async def handle_message(message: Message):
 /premium_add ID - активировать премиум
 /premium_remove ID - отключить премиум  
 /user_info ID - полная информация
-/user_list - список всех пользователей
+/user_list [premium] [ДНЕЙ] - список пользователей по страницам
 
 💎 = Премиум | 👤 = Обычный"""
                 
@@ -971,6 +3747,12 @@ async def handle_message(message: Message):
 🗑️ Очистка временных файлов
 ⚙️ Обновление зависимостей
 
+⏱️ Диагностика:
+/timings - время хендлеров, кнопок и SQL
+/timings reset - сбросить статистику
+/profile СЕК - сэмплирующий профилировщик
+/startup - профиль холодного старта
+
 ⚠️ Некоторые операции могут временно остановить бота"""
             await message.answer(response, reply_markup=create_admin_keyboard())
             return
@@ -1170,36 +3952,19 @@ async def handle_message(message: Message):
     elif text == "🌐 Язык":
         current_lang = get_user_language(user_id)
         new_lang = 'en' if current_lang == 'ru' else 'ru'
-        set_user_language(user_id, new_lang)
+        await set_user_language(user_id, new_lang)
         
         response = "🌐 Language changed to English" if new_lang == 'en' else "🌐 Язык изменен на русский"
         keyboard = create_main_keyboard(user_id)
         await message.answer(response, reply_markup=keyboard)
         return
     
-    elif text == "🎵 Моя музыка":
-        response = """🎵 МОЯ МУЗЫКА
-
-📂 История скачиваний
-❤️ Избранные треки  
-📝 Мои плейлисты
-🔄 Последние 10 треков
-
-Функция в разработке - скоро будет доступна!"""
-        keyboard = create_main_keyboard(user_id)
-        await message.answer(response, reply_markup=keyboard)
-        return
-    
-    elif text == "❤️ Избранное":
-        response = """❤️ ИЗБРАННОЕ
-
-🎵 Сохраненные треки: 0
-📝 Любимые плейлисты: 0
-⭐ Топ исполнители: 0
-
-Добавляйте треки в избранное во время поиска!"""
-        keyboard = create_main_keyboard(user_id)
-        await message.answer(response, reply_markup=keyboard)
+    elif text in ("🎵 Моя музыка", "❤️ Избранное"):
+        if not db.available:
+            await message.answer("❌ История недоступна: нет подключения к базе", reply_markup=create_main_keyboard(user_id))
+            return
+        response, keyboard = await render_library_page('h' if text == "🎵 Моя музыка" else 'f', user_id)
+        await message.answer(response, reply_markup=keyboard or create_main_keyboard(user_id))
         return
     
     elif text == "📝 Плейлисты":
@@ -1215,11 +3980,12 @@ async def handle_message(message: Message):
         return
     
     elif text == "🎛️ Качество":
-        response = """🎛️ КАЧЕСТВО АУДИО
+        _, bitrate = await download_quota(user_id)
+        response = f"""🎛️ КАЧЕСТВО АУДИО
 
-🔊 Текущее: 192 kbps MP3
-💎 Премиум: 320 kbps MP3
-🎧 Форматы: MP3, FLAC
+🔊 Текущее: {bitrate} kbps MP3
+🆓 Бесплатно: {FREE_BITRATE} kbps MP3
+💎 Премиум: {PREMIUM_BITRATE} kbps MP3
 
 Улучшите качество с премиум подпиской!"""
         keyboard = create_main_keyboard(user_id)
@@ -1227,32 +3993,32 @@ async def handle_message(message: Message):
         return
     
     elif text == "🔥 Топ треки":
-        response = """🔥 ТОП ТРЕКИ
-
-1. 🎵 Популярный трек 1
-2. 🎵 Популярный трек 2  
-3. 🎵 Популярный трек 3
-4. 🎵 Популярный трек 4
-5. 🎵 Популярный трек 5
-
-Нажмите на трек для скачивания!"""
-        keyboard = create_main_keyboard(user_id)
-        await message.answer(response, reply_markup=keyboard)
+        chart = await charts.top('week', 10)
+        if not chart:
+            await message.answer("🔥 ТОП ТРЕКИ\n\nПока нет данных — скачайте что-нибудь первым!", reply_markup=create_main_keyboard(user_id))
+            return
+        await shared_state.set('search', user_id, chart, ttl=SEARCH_RESULTS_TTL)
+        lines = [f"{i}. 🎵 {track['title']}" for i, track in enumerate(chart, 1)]
+        response = "🔥 ТОП ТРЕКИ ЗА НЕДЕЛЮ\n\n" + "\n".join(lines) + "\n\nНажмите на трек для скачивания!"
+        favorites = await db.favorite_urls(user_id, [track['url'] for track in chart])
+        await message.answer(response, reply_markup=create_search_results_keyboard(chart, user_id, favorites))
         return
     
     elif text == "📈 Тренды":
-        response = """📈 МУЗЫКАЛЬНЫЕ ТРЕНДЫ
-
-🔥 Сегодня популярно:
-• Поп музыка
-• Рэп и хип-хоп
-• Электронная музыка
-• Рок баллады
-• Классические хиты
-
-Ищите трендовую музыку!"""
-        keyboard = create_main_keyboard(user_id)
-        await message.answer(response, reply_markup=keyboard)
+        hour_chart = await charts.top('hour', 5)
+        day_chart = await charts.top('day', 5)
+        if not hour_chart and not day_chart:
+            await message.answer("📈 МУЗЫКАЛЬНЫЕ ТРЕНДЫ\n\nПока нет данных — ищите и скачивайте музыку!", reply_markup=create_main_keyboard(user_id))
+            return
+        hour_urls = {track['url'] for track in hour_chart}
+        chart = hour_chart + [track for track in day_chart if track['url'] not in hour_urls]
+        await shared_state.set('search', user_id, chart, ttl=SEARCH_RESULTS_TTL)
+        response = "📈 МУЗЫКАЛЬНЫЕ ТРЕНДЫ\n\n🔥 За час:\n"
+        response += "\n".join(f"• {track['title']}" for track in hour_chart) or "• —"
+        response += "\n\n📅 За сутки:\n"
+        response += "\n".join(f"• {track['title']}" for track in day_chart) or "• —"
+        favorites = await db.favorite_urls(user_id, [track['url'] for track in chart])
+        await message.answer(response, reply_markup=create_search_results_keyboard(chart, user_id, favorites))
         return
     
     elif text == "⚙️ Настройки":
@@ -1304,33 +4070,474 @@ async def handle_message(message: Message):
     else:
         search_query = text
         
+        # Ссылка на трек, плейлист или альбом
+        if search_query and re.match(r'https?://\S+$', search_query.strip()):
+            if user_id in playlist_tasks:
+                await message.answer("⏳ Дождитесь окончания текущей загрузки плейлиста")
+                return
+            # Плейлист скачивается в фоне, чтобы не задерживать остальные обновления пользователя
+            task = asyncio.create_task(handle_url(message, search_query.strip()))
+            playlist_tasks[user_id] = task
+            task.add_done_callback(lambda done: playlist_finished(user_id, done))
+            return
+        
         # Проверяем что это действительно поисковый запрос
         if search_query and len(search_query) >= 2 and not search_query.startswith('/'):
-            status_msg = await message.answer("🔍 Ищу музыку...")
-            
-            try:
-                results = await downloader.search_music(search_query, 5)
-                
-                if not results:
-                    await status_msg.edit_text("❌ Ничего не найдено. Попробуйте другой запрос.")
-                    return
-                
-                # Сохраняем результаты для пользователя
-                user_search_results[user_id] = results
-                
-                response = f"🔍 Найдено {len(results)} результатов для '{search_query}':\n\n"
-                keyboard = create_search_results_keyboard(results, user_id)
-                
-                await status_msg.edit_text(response, reply_markup=keyboard)
-                
-            except Exception as e:
-                print(f"Search error: {e}")
-                await status_msg.edit_text("❌ Ошибка поиска. Попробуйте позже.")
+            # Новый запрос заменяет незавершённый предыдущий: выигрывает всегда последний
+            previous = user_searches.pop(user_id, None)
+            if previous and not previous.done():
+                previous.cancel()
+                downloader.search_stats['superseded'] += 1
+            task = asyncio.create_task(run_user_search(message, search_query))
+            user_searches[user_id] = task
+            task.add_done_callback(lambda done: user_searches.pop(user_id, None) if user_searches.get(user_id) is done else None)
         else:
             # Неизвестная команда
             keyboard = create_main_keyboard(user_id)
             await message.answer("❓ Неизвестная команда. Используйте кнопки или введите название трека для поиска.", reply_markup=keyboard)
 
+# Поиск по сообщению идёт в фоне, чтобы следующий запрос пользователя мог его отменить
+user_searches: Dict[int, asyncio.Task] = {}
+
+async def run_user_search(message: Message, search_query: str):
+    user_id = message.from_user.id
+    status_msg = await message.answer("🔍 Ищу музыку...")
+    
+    try:
+        results = await downloader.search_music(search_query, 5)
+        
+        if not results:
+            await status_msg.edit_text("❌ Ничего не найдено. Попробуйте другой запрос.")
+            return
+        
+        # Сохраняем результаты для пользователя, только если запрос всё ещё последний
+        if user_searches.get(user_id) is not asyncio.current_task():
+            return
+        await shared_state.set('search', user_id, results, ttl=SEARCH_RESULTS_TTL)
+        prefetcher.schedule(user_id, results)
+        charts.record_search(results)
+        
+        response = f"🔍 Найдено {len(results)} результатов для '{search_query}':\n\n"
+        favorites = await db.favorite_urls(user_id, [result['url'] for result in results])
+        keyboard = create_search_results_keyboard(results, user_id, favorites)
+        
+        await status_msg.edit_text(response, reply_markup=keyboard)
+    
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await status_msg.edit_text(f"⏭️ Поиск '{search_query}' заменён новым запросом")
+        raise
+    except Exception as e:
+        print(f"Search error: {e}")
+        await status_msg.edit_text("❌ Ошибка поиска. Попробуйте позже.")
+
+async def record_download(user_id: int, track: Dict):
+    await record_downloads(user_id, [track])
+
+async def record_downloads(user_id: int, tracks: List[Dict]):
+    # Обновляем статистику
+    user_stats['downloads'] += len(tracks)
+    for track in tracks:
+        local_index.add(track)
+        charts.record_download(track)
+    
+    # Сохраняем в БД одной пачкой: квота и история (при отказе базы — через журнал)
+    if DATABASE_URL and tracks:
+        await db.write(_store_downloads, user_id, tracks, datetime.now())
+
+async def download_quota(user_id: int) -> tuple:
+    # (остаток на сегодня или None без ограничений, битрейт тарифа)
+    user_data = await db.get_user(user_id)
+    if not user_data:
+        return None, FREE_BITRATE
+    if user_data.get('is_premium', False):
+        return None, PREMIUM_BITRATE
+    daily_downloads = user_data.get('daily_downloads', 0) or 0
+    if user_data.get('last_download_date') != datetime.now().date():
+        daily_downloads = 0
+    return max(0, FREE_DAILY_LIMIT - daily_downloads), FREE_BITRATE
+
+def audio_input(file_path: str, title: str):
+    # Локальный Bot API читает файл сам по file:// — без multipart загрузки через HTTP сессию
+    if TELEGRAM_API_LOCAL:
+        return f"file://{os.path.abspath(file_path)}"
+    return FSInputFile(file_path, filename=f"{title}.mp3")
+
+async def deliver_track(message: Message, track: Dict, bitrate: int = FREE_BITRATE, prefetched: Optional[Dict] = None) -> bool:
+    """Отправляет трек в чат: по file_id из кэша или после скачивания"""
+    started = time.monotonic()
+    delivered = await _deliver_track(message, track, bitrate, prefetched)
+    # В личном чате chat.id совпадает с user_id
+    rollups.record(message.chat.id, delivered, track.get('duration_seconds'), time.monotonic() - started)
+    return delivered
+
+async def _deliver_track(message: Message, track: Dict, bitrate: int, prefetched: Optional[Dict]) -> bool:
+    cached = await audio_cache.get(track['url'], bitrate)
+    if cached:
+        try:
+            await message.answer_audio(
+                cached['file_id'],
+                title=track['title'],
+                performer=track.get('uploader', 'Unknown')
+            )
+            return True
+        except Exception as e:
+            print(f"Cached send error: {e}")
+    
+    # Файлы закреплены на время отправки, чтобы уборщик их не удалил
+    with downloader.pin(track['url']):
+        # Длительность известна из поиска: заведомо неотправляемое отклоняем без скачивания
+        try:
+            plan_delivery(track.get('duration_seconds'))
+            # Предзагрузка уже положила варианты всех битрейтов рядом — download_audio их подхватит
+            file_paths = await downloader.download_audio(
+                track['url'], bitrate, info=prefetched['info'] if prefetched else None
+            )
+        except DeliveryRejected as e:
+            await message.answer(f"❌ {track['title']}\n{e}")
+            return False
+        if not file_paths or not all(os.path.exists(path) for path in file_paths):
+            return False
+        
+        try:
+            # Отправляем файл (или части длинной записи)
+            for number, file_path in enumerate(file_paths, 1):
+                title = track['title'] if len(file_paths) == 1 else f"{track['title']} ({number}/{len(file_paths)})"
+                sent = await message.answer_audio(
+                    audio_input(file_path, title),
+                    title=title,
+                    performer=track.get('uploader', 'Unknown')
+                )
+            if len(file_paths) == 1:
+                await audio_cache.put(track, sent.audio.file_id, bitrate)
+        except Exception as e:
+            print(f"Send error: {e}")
+            return False
+    
+    # Когда все варианты уже есть в Telegram, локальные файлы больше не нужны
+    cached_variants = await asyncio.gather(*(audio_cache.get(track['url'], variant) for variant in AUDIO_BITRATES))
+    if all(cached_variants):
+        downloader.release_variants(track['url'])
+    return True
+
+# Моя музыка и избранное: повторная доставка по file_id
+def _library_cursor(item: Dict) -> str:
+    return f"{item['at'].strftime('%Y%m%d%H%M%S%f')}:{item['id']}"
+
+async def render_library_page(kind: str, user_id: int, cursor: Optional[tuple] = None, newer: bool = False) -> tuple:
+    title, empty_text = LIBRARY_VIEWS[kind][2:]
+    items, has_more = await db.library_page(kind, user_id, cursor, newer)
+    if not items:
+        return f"{title}\n\n{empty_text}", None
+    
+    for item in items:
+        item['duration'] = downloader._format_duration(item.get('duration_seconds'))
+    # Списки истории и избранного хранятся раздельно, кнопки ссылаются на id записи, а не на позицию
+    await shared_state.set(f'library:{kind}', user_id, [{key: value for key, value in item.items() if key != 'at'} for item in items], ttl=SEARCH_RESULTS_TTL)
+    
+    builder = InlineKeyboardBuilder()
+    for item in items:
+        name = item['title'][:45] + "..." if len(item['title']) > 45 else item['title']
+        buttons = [InlineKeyboardButton(text=f"▶️ {name} ({item['duration']})", callback_data=f"play:{kind}:{item['id']}")]
+        if kind == 'f':
+            buttons.append(InlineKeyboardButton(text="💔", callback_data=f"unfav:f:{item['id']}"))
+        builder.row(*buttons)
+    
+    # Назад — к более новым, вперёд — к более старым записям
+    has_newer = has_more if newer else cursor is not None
+    has_older = True if newer else has_more
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"lib:{kind}:p:{_library_cursor(items[0])}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton(text="Раньше ➡️", callback_data=f"lib:{kind}:n:{_library_cursor(items[-1])}"))
+    if navigation:
+        builder.row(*navigation)
+    return f"{title}\n\nНажмите на трек, чтобы прослушать снова:", builder.as_markup()
+
+async def deliver_library_track(message: Message, track: Dict, bitrate: int) -> bool:
+    # Трек уже был у пользователя: отдаём копию из Telegram, подойдёт любой битрейт
+    cached = await audio_cache.get(track['url'], bitrate) or await audio_cache.get_any(track['url'], bitrate)
+    if cached:
+        try:
+            await message.answer_audio(
+                cached['file_id'],
+                title=track['title'],
+                performer=track.get('uploader') or 'Unknown'
+            )
+            return True
+        except Exception as e:
+            print(f"Library send error: {e}")
+    # file_id нет только у записей, отправленных частями, — их приходится собирать заново
+    return await deliver_track(message, track, bitrate)
+
+# Плейлисты и альбомы по ссылке
+playlist_tasks: Dict[int, asyncio.Task] = {}
+
+def playlist_finished(user_id: int, task: asyncio.Task):
+    # Плейлист пользователя завершён: убираем его задачу, ошибку — в лог
+    if playlist_tasks.get(user_id) is task:
+        del playlist_tasks[user_id]
+    if not task.cancelled() and task.exception():
+        error = task.exception()
+        print(f"Playlist error for {user_id}: {error}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+async def handle_url(message: Message, url: str):
+    user_id = message.from_user.id
+    status_msg = await message.answer("🔗 Обрабатываю ссылку...")
+    
+    info = await downloader.extract_url(url)
+    if not info:
+        await status_msg.edit_text("❌ Не удалось открыть ссылку")
+        return
+    
+    entries = [entry for entry in (info.get('entries') or []) if entry] if info.get('_type') == 'playlist' else [info]
+    tracks = [track for track in (downloader.track_from_entry(entry) for entry in entries) if track]
+    if not tracks:
+        await status_msg.edit_text("❌ В ссылке нет доступных треков")
+        return
+    
+    remaining, bitrate = await download_quota(user_id)
+    if remaining is not None and remaining < len(tracks):
+        if remaining == 0:
+            await status_msg.edit_text(get_text(user_id, 'daily_limit'))
+            return
+        tracks = tracks[:remaining]
+    
+    title = info.get('title') or 'Плейлист'
+    await status_msg.edit_text(f"⬇️ {title}\n🎵 Треков: {len(tracks)}")
+    
+    # У пользователя одновременно один плейлист (playlist_tasks), поэтому семафор локальный
+    semaphore = asyncio.Semaphore(PLAYLIST_PARALLEL_PER_USER)
+    delivered = []
+    failed = 0
+    
+    async def fetch(index: int, track: Dict):
+        nonlocal failed
+        async with semaphore:
+            # Ссылка допущена за один токен загрузки — он покрывает первый трек, остальные идут в темпе лимита
+            if index:
+                await admission.acquire(user_id, 'download')
+            if await deliver_track(message, track, bitrate):
+                delivered.append(track)
+            else:
+                failed += 1
+    
+    await asyncio.gather(*(fetch(index, track) for index, track in enumerate(tracks)))
+    await record_downloads(user_id, delivered)
+    
+    summary = f"✅ {title}\n📤 Отправлено: {len(delivered)}/{len(tracks)}"
+    if failed:
+        summary += f"\n❌ Ошибок: {failed}"
+    if remaining is not None and remaining < len(entries):
+        summary += f"\n⚠️ Дневной лимит: скачано только {len(tracks)} из {len(entries)}"
+    await status_msg.edit_text(summary)
+
+# Потоковый экспорт таблиц через COPY
+EXPORT_QUERIES = {
+    'users': 'SELECT * FROM users ORDER BY user_id',
+    'downloads': 'SELECT * FROM downloads ORDER BY id',
+}
+export_tasks: Dict[str, asyncio.Task] = {}
+
+class GzipChunkWriter:
+    """Сжимает поток COPY в части gzip на диске; отправка частей идёт отдельной задачей и не тормозит COPY"""
+
+    def __init__(self, chat_id: int, name: str):
+        self.chat_id = chat_id
+        self.name = name
+        self.part = 0
+        self.rows = 0
+        self.compressor = None
+        self.buffer: List[bytes] = []
+        self.size = 0
+        self.tail = b''
+        self.directory = tempfile.mkdtemp(prefix='music_bot_export-')
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.uploader = asyncio.create_task(self._upload())
+
+    async def write(self, data: bytes):
+        # Загрузка упала — прерываем COPY, а не продолжаем копить части
+        if self.uploader.done():
+            self.uploader.result()
+            raise RuntimeError("отправка частей остановилась")
+        # Режем части только по границе строки, чтобы каждая часть читалась отдельно
+        data = self.tail + data
+        cut = data.rfind(b'\n') + 1
+        self.tail = data[cut:]
+        if not cut:
+            return
+        chunk = data[:cut]
+        self.rows += chunk.count(b'\n')
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        loop = asyncio.get_running_loop()
+        compressed = await loop.run_in_executor(None, self.compressor.compress, chunk)
+        if compressed:
+            self.buffer.append(compressed)
+            self.size += len(compressed)
+        if self.size >= EXPORT_CHUNK_SIZE:
+            await self._finish_part()
+
+    async def close(self):
+        """Дописывает последнюю часть и ждёт, пока все части уйдут в Telegram"""
+        if self.tail:
+            await self.write(b'\n')
+        if self.compressor is not None or not self.part:
+            await self._finish_part()
+        self.ready.put_nowait(None)
+        await self.uploader
+
+    def discard(self):
+        self.uploader.cancel()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def _finish_part(self):
+        # Часть ложится на диск и встаёт в очередь отправки; COPY продолжается, не дожидаясь Telegram
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.buffer.append(self.compressor.flush())
+        self.part += 1
+        path = os.path.join(self.directory, f"{self.name}.part{self.part:03d}.gz")
+        buffer = self.buffer
+        self.compressor = None
+        self.buffer = []
+        self.size = 0
+        
+        def save():
+            with open(path, 'wb') as f:
+                f.writelines(buffer)
+        
+        await asyncio.get_running_loop().run_in_executor(None, save)
+        self.ready.put_nowait((path, self.part, self.rows))
+
+    async def _upload(self):
+        while True:
+            item = await self.ready.get()
+            if item is None:
+                return
+            path, part, rows = item
+            await bot.send_document(
+                self.chat_id, FSInputFile(path), caption=f"💾 {self.name} — часть {part}, строк всего: {rows}"
+            )
+            os.remove(path)
+
+async def export_table(chat_id: int, table: str, fmt: str):
+    query = EXPORT_QUERIES[table]
+    name = f"{table}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    writer = GzipChunkWriter(chat_id, name)
+    started = time.monotonic()
+    try:
+        # Свой таймаут вместо command_timeout пула: COPY большой таблицы идёт дольше минуты
+        async with db.acquire() as conn:
+            if fmt == 'json':
+                # JSON Lines: кавычки и разделитель, которых нет в JSON, отключают экранирование CSV
+                await conn.copy_from_query(
+                    f'SELECT row_to_json(t) FROM ({query}) t',
+                    output=writer.write, format='csv', quote='\x01', delimiter='\x02', timeout=EXPORT_TIMEOUT
+                )
+            else:
+                await conn.copy_from_query(query, output=writer.write, format='csv', header=True, timeout=EXPORT_TIMEOUT)
+        await writer.close()
+        await bot.send_message(
+            chat_id,
+            f"✅ Экспорт {table} ({fmt.upper()}) завершён: {writer.rows - (fmt == 'csv')} строк, {writer.part} частей "
+            f"за {time.monotonic() - started:.1f} сек"
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Export error: {e}")
+        await bot.send_message(chat_id, f"❌ Ошибка экспорта {table}: {e}")
+    finally:
+        writer.discard()
+
+def create_export_keyboard() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for table in EXPORT_QUERIES:
+        for fmt in ('csv', 'json'):
+            builder.button(text=f"{table} · {fmt.upper()}", callback_data=f"export:{table}:{fmt}")
+    builder.adjust(2)
+    return builder.as_markup()
+
+# Inline режим (@bot запрос)
+inline_lookups: Dict[int, asyncio.Task] = {}
+
+def _inline_result_id(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()[:32]
+
+async def answer_inline_query(inline_query: InlineQuery):
+    query = inline_query.query.strip()
+    
+    # Debounce: пока пользователь печатает, новый запрос отменяет эту задачу
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    started = time.monotonic()
+    
+    results = downloader.cached_search(query, INLINE_RESULTS) or local_index.search(query, INLINE_RESULTS)
+    # Токен поиска списываем только за удалённый поиск; без токена отвечаем тем, что есть в кэшах
+    if (len(results) < INLINE_RESULTS and not update_queue.draining
+            and await admission.admit(inline_query.from_user.id, 'search') is None):
+        # Без shield: отмена или дедлайн снимают ожидающего, и общий поиск останавливается,
+        # если его больше никто не ждёт
+        try:
+            remote = await asyncio.wait_for(
+                downloader.search_music(query, INLINE_RESULTS, flat=True),
+                INLINE_DEADLINE - (time.monotonic() - started)
+            )
+            if remote:
+                results = remote
+        except asyncio.TimeoutError:
+            timings.record("inline:deadline_miss", time.monotonic() - started)
+    
+    cached_audio = await audio_cache.get_many([result['url'] for result in results])
+    items = []
+    for result in results:
+        cached = cached_audio.get(result['url'])
+        if cached:
+            items.append(InlineQueryResultCachedAudio(
+                id=_inline_result_id(result['url']),
+                audio_file_id=cached['file_id']
+            ))
+        else:
+            duration = result.get('duration') or downloader._format_duration(result.get('duration_seconds'))
+            items.append(InlineQueryResultArticle(
+                id=_inline_result_id(result['url']),
+                title=result['title'],
+                description=f"{result.get('uploader') or 'Unknown'} • {duration}",
+                input_message_content=InputTextMessageContent(message_text=f"🎵 {result['title']}\n{result['url']}")
+            ))
+    
+    # Пустой ответ кэшируем коротко: результаты могут появиться после прогрева
+    await inline_query.answer(items, cache_time=INLINE_CACHE_TIME if items else 5, is_personal=False)
+    timings.record("inline:answer", time.monotonic() - started)
+
+@dp.inline_query()
+async def handle_inline_query(inline_query: InlineQuery):
+    user_id = inline_query.from_user.id
+    previous = inline_lookups.pop(user_id, None)
+    if previous:
+        previous.cancel()
+    
+    if len(inline_query.query.strip()) < 2:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    
+    # Хендлер не ждёт поиска, чтобы следующий запрос пользователя мог отменить этот
+    task = asyncio.create_task(answer_inline_query(inline_query))
+    inline_lookups[user_id] = task
+    task.add_done_callback(lambda done: inline_lookups.pop(user_id, None) if inline_lookups.get(user_id) is done else None)
+
+# База недоступна: вместо падения хендлера короткий ответ пользователю
+@dp.error(ExceptionTypeFilter(DatabaseUnavailable))
+async def handle_database_unavailable(event: ErrorEvent):
+    text = f"⚠️ База данных временно недоступна, повторите через {db.time_to_retry():.0f} сек"
+    if event.update.message:
+        await event.update.message.answer(text)
+    elif event.update.callback_query:
+        await event.update.callback_query.answer(text, show_alert=True)
+    return True
+
 # Обработчик кнопок
 @dp.callback_query()
 async def handle_callback(callback):
@@ -1340,11 +4547,11 @@ async def handle_callback(callback):
     if data.startswith("download:"):
         index = int(data.split(":")[1])
         
-        if user_id not in user_search_results:
+        results = await shared_state.get('search', user_id)
+        if not results:
             await callback.answer("❌ Результаты поиска устарели")
             return
         
-        results = user_search_results[user_id]
         if index >= len(results):
             await callback.answer("❌ Неверный трек")
             return
@@ -1352,67 +4559,87 @@ async def handle_callback(callback):
         track = results[index]
         
         # Проверка лимитов
-        user_data = await db.get_user(user_id)
-        if user_data and not user_data.get('is_premium', False):
-            daily_downloads = user_data.get('daily_downloads', 0)
-            if daily_downloads >= FREE_DAILY_LIMIT:
-                await callback.answer(get_text(user_id, 'daily_limit'))
-                return
+        remaining, bitrate = await download_quota(user_id)
+        if remaining == 0:
+            await callback.answer(get_text(user_id, 'daily_limit'))
+            return
         
+        prefetcher.record_pick(index, track['url'])
         await callback.message.edit_text(f"⬇️ {get_text(user_id, 'downloading')}\n🎵 {track['title']}")
         
-        # Скачивание
-        file_path = await downloader.download_audio(track['url'], track['title'])
-        
-        if file_path and os.path.exists(file_path):
-            try:
-                # Отправляем файл
-                audio_file = FSInputFile(file_path, filename=f"{track['title']}.mp3")
-                await callback.message.answer_audio(
-                    audio_file,
-                    title=track['title'],
-                    performer=track.get('uploader', 'Unknown')
-                )
-                
-                # Обновляем статистику
-                user_stats['downloads'] += 1
-                
-                # Сохраняем в БД
-                if db.pool:
-                    async with db.pool.acquire() as conn:
-                        try:
-                            await conn.execute('''
-                                UPDATE users SET 
-                                    total_downloads = total_downloads + 1,
-                                    daily_downloads = CASE 
-                                        WHEN last_download_date = CURRENT_DATE THEN daily_downloads + 1
-                                        ELSE 1
-                                    END,
-                                    last_download_date = CURRENT_DATE
-                                WHERE user_id = $1
-                            ''', user_id)
-                            
-                            await conn.execute('''
-                                INSERT INTO downloads (user_id, title, duration)
-                                VALUES ($1, $2, $3)
-                            ''', user_id, track['title'], track['duration'])
-                        except:
-                            pass
-                
-                await callback.message.edit_text(f"✅ {get_text(user_id, 'download_success')}\n🎵 {track['title']}")
-                
-                # Удаляем временный файл
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-                
-            except Exception as e:
-                print(f"Send error: {e}")
-                await callback.message.edit_text(f"❌ {get_text(user_id, 'download_error')}")
+        # Скачивание: сначала забираем результат предзагрузки, если угадали трек
+        prefetched = await prefetcher.take(user_id, track)
+        if await deliver_track(callback.message, track, bitrate, prefetched):
+            await record_download(user_id, track)
+            await callback.message.edit_text(f"✅ {get_text(user_id, 'download_success')}\n🎵 {track['title']}")
         else:
             await callback.message.edit_text(f"❌ {get_text(user_id, 'download_error')}")
     
+    elif data.startswith("export:"):
+        _, table, fmt = data.split(":")
+        if user_id != ADMIN_ID or table not in EXPORT_QUERIES or fmt not in ('csv', 'json'):
+            await callback.answer("❌ Нет доступа")
+            return
+        key = f"{table}:{fmt}"
+        if key in export_tasks:
+            await callback.answer("⏳ Этот экспорт уже выполняется")
+            return
+        # Выгрузка идёт в фоне и не занимает очередь апдейтов админа
+        task = asyncio.create_task(export_table(callback.message.chat.id, table, fmt))
+        export_tasks[key] = task
+        task.add_done_callback(lambda done: export_tasks.pop(key, None))
+        await callback.answer(f"💾 Экспорт {table} ({fmt.upper()}) запущен")
+        return
+    
+    elif data.startswith("ul:"):
+        if user_id != ADMIN_ID:
+            await callback.answer("❌ Нет доступа")
+            return
+        _, premium_only, active_days, direction, created_at, cursor_user = data.split(":")
+        cursor = (datetime.strptime(created_at, '%Y%m%d%H%M%S%f'), int(cursor_user))
+        text, keyboard = await render_user_page(premium_only == '1', int(active_days), cursor, newer=direction == 'p')
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    
+    elif data.startswith("fav:"):
+        results = await shared_state.get('search', user_id)
+        index = int(data.split(":")[1])
+        if not results or index >= len(results) or not db.available:
+            await callback.answer("❌ Результаты поиска устарели")
+            return
+        added = await db.toggle_favorite(user_id, results[index])
+        favorites = await db.favorite_urls(user_id, [result['url'] for result in results])
+        await callback.message.edit_reply_markup(reply_markup=create_search_results_keyboard(results, user_id, favorites))
+        await callback.answer("❤️ Добавлено в избранное" if added else "💔 Удалено из избранного")
+        return
+    
+    elif data.startswith("play:") or data.startswith("unfav:"):
+        action, kind, item_id = data.split(":")
+        items = await shared_state.get(f'library:{kind}', user_id) or []
+        track = next((item for item in items if str(item['id']) == item_id), None)
+        if track is None:
+            await callback.answer("❌ Список устарел, откройте его заново")
+            return
+        if action == "unfav":
+            removed = await db.remove_favorite(user_id, track['url'])
+            await callback.answer("💔 Удалено из избранного" if removed else "Трека уже нет в избранном")
+            response, keyboard = await render_library_page('f', user_id)
+            await callback.message.edit_text(response, reply_markup=keyboard)
+            return
+        await callback.answer(f"▶️ {track['title'][:50]}")
+        _, bitrate = await download_quota(user_id)
+        if not await deliver_library_track(callback.message, track, bitrate):
+            await callback.message.answer(f"❌ {get_text(user_id, 'download_error')}")
+        return
+    
+    elif data.startswith("lib:"):
+        _, kind, direction, moment, item_id = data.split(":")
+        if kind not in LIBRARY_VIEWS:
+            await callback.answer()
+            return
+        cursor = (datetime.strptime(moment, '%Y%m%d%H%M%S%f'), int(item_id))
+        response, keyboard = await render_library_page(kind, user_id, cursor, newer=direction == 'p')
+        await callback.message.edit_text(response, reply_markup=keyboard)
+    
     elif data == "back_to_menu":
         keyboard = create_main_keyboard(user_id)
         await callback.message.edit_text(get_text(user_id, 'start'), reply_markup=keyboard)
@@ -1438,41 +4665,452 @@ def health_monitor_only():
     
     threading.Thread(target=monitor, daemon=True).start()
 
-def signal_handler(signum, frame):
-    print("Shutting down...")
-    sys.exit(0)
+from aiohttp import web, ClientError, ClientSession, ClientTimeout, UnixConnector
 
-from aiohttp import web
-from aiogram.webhook.aiohttp_server import setup_application
+# Очередь входящих обновлений
+class UserOrderedQueue:
+    """Ограниченная очередь: обновления одного пользователя по порядку, разных — параллельно"""
+
+    def __init__(self, maxsize: int, workers: int, per_user_limit: int):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.lanes: Dict[Any, deque] = {}
+        self.size = 0
+        self.stats = Counter()
+        self._ready = None
+        self._space = None
+        self._tasks = []
+        self._busy = set()
+        self.draining = False
+
+    def start(self, process: Callable[[Any], Awaitable[Any]]):
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._tasks = [asyncio.create_task(self._worker(process)) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def drain(self, timeout: float) -> List[Any]:
+        """Перестаёт брать новые обновления, ждёт текущие до timeout и возвращает невыполненные"""
+        self.draining = True
+        for task in self._tasks:
+            if task not in self._busy:
+                task.cancel()
+        busy = list(self._busy)
+        if busy:
+            _, unfinished = await asyncio.wait(busy, timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+                self.stats['drain_cancelled'] += 1
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        
+        leftover = [item for lane in self.lanes.values() for item in lane]
+        self.lanes.clear()
+        self.size = 0
+        return leftover
+
+    async def put(self, key, item, timeout: float) -> bool:
+        lane = self.lanes.get(key)
+        if lane is not None and len(lane) >= self.per_user_limit:
+            self.stats['shed_user'] += 1
+            return False
+        
+        if self.size >= self.maxsize:
+            # Backpressure: держим webhook-запрос, пока не освободится место
+            self.stats['backpressure'] += 1
+            try:
+                await asyncio.wait_for(self._wait_space(), timeout)
+            except asyncio.TimeoutError:
+                self.stats['shed_full'] += 1
+                return False
+        
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = deque()
+            self._ready.put_nowait(key)
+        lane.append(item)
+        self.size += 1
+        self.stats['enqueued'] += 1
+        self.stats['peak'] = max(self.stats['peak'], self.size)
+        return True
+
+    async def _wait_space(self):
+        while self.size >= self.maxsize:
+            self._space.clear()
+            await self._space.wait()
+
+    async def _worker(self, process):
+        task = asyncio.current_task()
+        while not self.draining:
+            key = await self._ready.get()
+            lane = self.lanes[key]
+            while lane and not self.draining:
+                item = lane.popleft()
+                self.size -= 1
+                self._space.set()
+                self._busy.add(task)
+                try:
+                    await process(item)
+                    self.stats['processed'] += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    print(f"Update processing error: {e}")
+                finally:
+                    self._busy.discard(task)
+            # При дренаже остаток полосы остаётся в очереди и сохраняется для следующего инстанса
+            if not lane:
+                del self.lanes[key]
+
+    def snapshot(self) -> Dict:
+        return {"size": self.size, "maxsize": self.maxsize, "users": len(self.lanes), "stats": dict(self.stats)}
+
+    def summary(self, snapshot: Optional[Dict] = None) -> str:
+        snapshot = snapshot or self.snapshot()
+        stats = Counter(snapshot['stats'])
+        return (
+            f"• В очереди: {snapshot['size']}/{snapshot['maxsize']} (пик {stats['peak']}), пользователей: {snapshot['users']}\n"
+            f"• Обработано: {stats['processed']} | ошибок: {stats['failed']}\n"
+            f"• Backpressure: {stats['backpressure']} | сброшено: {stats['shed_full'] + stats['shed_user']}"
+        )
+
+update_queue = UserOrderedQueue(UPDATE_QUEUE_SIZE, UPDATE_WORKERS, UPDATE_PER_USER_LIMIT)
+
+def _update_user_key(update: Update):
+    for field in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result', 'my_chat_member'):
+        event = getattr(update, field, None)
+        if event is not None and getattr(event, 'from_user', None):
+            return event.from_user.id
+    return f"update:{update.update_id}"
+
+async def process_update(update: Update):
+    await dp.feed_update(bot, update)
+
+# Маршрутизация между воркерами: у каждого своя очередь, поэтому пользователь закреплён за одним воркером
+route_stats = Counter()
+peer_sessions: Dict[int, ClientSession] = {}
+
+def _worker_socket(index: int) -> str:
+    return os.path.join(METRICS_DIR, f"worker-{index}.sock")
+
+def _update_owner(key) -> int:
+    if WEB_WORKERS <= 1 or not isinstance(key, int):
+        return WORKER_INDEX
+    return key % WEB_WORKERS
+
+async def enqueue_update(update: Update) -> int:
+    """HTTP-статус для Telegram: 503 — доставить повторно позже"""
+    if update_queue.draining:
+        # Telegram повторит доставку, и обновление достанется следующему инстансу
+        return 503
+    if not await update_queue.put(_update_user_key(update), update, UPDATE_ENQUEUE_TIMEOUT):
+        print(f"Update {update.update_id} shed: queue full")
+    return 200
+
+async def route_update(update: Update, payload) -> int:
+    owner = _update_owner(_update_user_key(update))
+    if owner == WORKER_INDEX:
+        return await enqueue_update(update)
+    
+    session = peer_sessions.get(owner)
+    if session is None:
+        session = peer_sessions[owner] = ClientSession(
+            connector=UnixConnector(path=_worker_socket(owner)),
+            timeout=ClientTimeout(total=UPDATE_ENQUEUE_TIMEOUT + 1),
+        )
+    try:
+        async with session.post('http://worker/update', data=payload, headers={'Content-Type': 'application/json'}) as response:
+            route_stats['forwarded'] += 1
+            return response.status
+    except (ClientError, asyncio.TimeoutError, OSError) as e:
+        # Владелец перезапускается: обрабатываем сами, порядок для этого пользователя может нарушиться
+        route_stats['fallback'] += 1
+        print(f"Update {update.update_id}: worker {owner} unreachable ({e}), processing locally")
+        return await enqueue_update(update)
+
+async def handle_peer_update(request: web.Request) -> web.Response:
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        print(f"Bad forwarded payload: {e}")
+        return web.Response(status=200)
+    return web.Response(status=await enqueue_update(update))
+
+async def start_peer_site(app):
+    # Внутренний приём пересланных обновлений — unix-сокет рядом со снимками метрик
+    path = _worker_socket(WORKER_INDEX)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    peer_app = web.Application()
+    peer_app.router.add_post('/update', handle_peer_update)
+    runner = web.AppRunner(peer_app)
+    await runner.setup()
+    await web.UnixSite(runner, path).start()
+    app['peer_runner'] = runner
+
+async def checkpoint_updates(updates: List[Update]):
+    if not updates:
+        return
+    payloads = [json.dumps(update.model_dump(mode='json', exclude_none=True)) for update in updates]
+    try:
+        async with db.acquire() as conn:
+            await conn.executemany('INSERT INTO pending_updates (payload) VALUES ($1::jsonb)', [(payload,) for payload in payloads])
+        print(f"💾 Сохранено необработанных обновлений: {len(payloads)}")
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить {len(payloads)} обновлений: {e}")
+
+async def resume_pending_updates():
+    # При перевыкатке старый инстанс получает SIGTERM уже после нашего старта и сохраняет остаток позже,
+    # поэтому таблицу опрашиваем первые PENDING_UPDATES_POLL_WINDOW секунд
+    await db.ready.wait()
+    deadline = time.monotonic() + PENDING_UPDATES_POLL_WINDOW
+    while not update_queue.draining:
+        resumed = await take_pending_updates()
+        if resumed:
+            print(f"▶️ Возобновлено обновлений предыдущего инстанса: {resumed}")
+        if time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(PENDING_UPDATES_POLL_INTERVAL)
+
+async def take_pending_updates() -> int:
+    # SKIP LOCKED делит сохранённые обновления между воркерами
+    resumed = 0
+    while True:
+        try:
+            async with db.acquire() as conn:
+                rows = await conn.fetch('''
+                    DELETE FROM pending_updates
+                    WHERE id IN (SELECT id FROM pending_updates ORDER BY id LIMIT 500 FOR UPDATE SKIP LOCKED)
+                    RETURNING id, payload, created_at
+                ''')
+        except Exception as e:
+            print(f"Pending updates resume error: {e}")
+            return resumed
+        if not rows:
+            return resumed
+        for row in sorted(rows, key=lambda r: r['id']):
+            if row['created_at'] and (datetime.now() - row['created_at']).total_seconds() > PENDING_UPDATES_MAX_AGE:
+                continue
+            update = Update.model_validate(json.loads(row['payload']), context={"bot": bot})
+            if await route_update(update, row['payload']) == 200:
+                resumed += 1
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    # Быстрый ответ Telegram: обновление уходит в очередь воркера-владельца, обработка — в его воркерах
+    if update_queue.draining:
+        return web.Response(status=503)
+    body = await request.read()
+    try:
+        update = Update.model_validate(json.loads(body), context={"bot": bot})
+    except Exception as e:
+        print(f"Bad webhook payload: {e}")
+        return web.Response(status=200)
+    
+    return web.Response(status=await route_update(update, body))
+
+async def handle_status(request: web.Request) -> web.Response:
+    metrics = aggregate_metrics()
+    return web.json_response({
+        "status": "full_music_bot_active",
+        "uptime": str(datetime.now() - start_time),
+        "workers": metrics["workers"],
+        "messages": metrics["messages"],
+        "users": len(metrics["users"]),
+        "downloads": metrics["downloads"],
+        "admission": dict(metrics["admission"]),
+        "timestamp": datetime.now().isoformat(),
+        "mode": "full_functional_bot"
+    })
 
 async def on_startup(app):
+    app['loop_watchdog'] = asyncio.create_task(loop_watchdog.run())
+    app['metrics_flush'] = asyncio.create_task(metrics_flush_loop())
+    app['local_index'] = asyncio.create_task(local_index_refresh_loop())
+    app['janitor'] = asyncio.create_task(janitor_loop())
+    if DATABASE_URL:
+        app['db_health'] = asyncio.create_task(db.health_loop())
+    app['rollup_flush'] = asyncio.create_task(rollup_flush_loop())
+    app['charts_checkpoint'] = asyncio.create_task(charts_checkpoint_loop())
+    update_queue.start(process_update)
+    if WEB_WORKERS > 1:
+        await start_peer_site(app)
+    if DATABASE_URL:
+        app['resume_updates'] = asyncio.create_task(resume_pending_updates())
+    startup.record("запуск процесса → приложение готово", time.perf_counter() - startup.started)
+    print(f"⏱️ Старт:\n{startup.report()}")
+    # yt-dlp грузится в фоне после того, как порт уже слушается
+    asyncio.get_running_loop().run_in_executor(downloader.search_executor, load_yt_dlp)
+    if WORKER_INDEX != 0:
+        return
+    app['partition_maintenance'] = asyncio.create_task(partition_maintenance_loop())
+    app['webhook'] = asyncio.create_task(ensure_webhook())
+
+async def ensure_webhook():
+    # Вебхук переживает рестарты: ставим только если он отличается от нужного
     webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/"
-    await bot.set_webhook(webhook_url)
-    print(f"✅ Webhook установлен: {webhook_url}")
+    try:
+        with startup.phase("проверка вебхука"):
+            info = await bot.get_webhook_info()
+            if info.url == webhook_url:
+                print(f"✅ Webhook уже установлен: {webhook_url}")
+                return
+            await bot.set_webhook(webhook_url)
+        print(f"✅ Webhook установлен: {webhook_url}")
+    except Exception as e:
+        print(f"Webhook setup error: {e}")
 
 async def on_shutdown(app):
-    print("🛑 Webhook снимается и сессия закрывается...")
-    await bot.delete_webhook()
+    print(f"🛑 Остановка: дренаж текущей работы (до {DRAIN_TIMEOUT:.0f} сек)...")
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    
+    # Новые обновления не берём, начатые дорабатывают до дедлайна, остаток — следующему инстансу
+    pending = await update_queue.drain(DRAIN_TIMEOUT)
+    
+    # Фоновые задачи пользователей: плейлисты, поиски и экспорты доводим, предзагрузку и inline бросаем
+    for user_id in list(prefetcher.sessions):
+        prefetcher.cancel(user_id)
+    for task in list(inline_lookups.values()):
+        task.cancel()
+    background = [*playlist_tasks.values(), *user_searches.values(), *export_tasks.values()]
+    if background:
+        _, unfinished = await asyncio.wait(background, timeout=max(0.0, deadline - time.monotonic()))
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+    downloader.stop()
+    prefetcher.executor.shutdown(wait=False, cancel_futures=True)
+    
+    for name in ('loop_watchdog', 'metrics_flush', 'local_index', 'janitor', 'rollup_flush', 'charts_checkpoint',
+                 'db_health', 'partition_maintenance', 'resume_updates', 'webhook'):
+        if name in app:
+            app[name].cancel()
+    loop_watchdog.stop()
+    
+    # Буферы в базу: необработанные обновления, агрегаты, чарты, журнал отложенных записей
+    await checkpoint_updates(pending)
+    await rollups.flush()
+    await charts.checkpoint()
+    await db.replay_journal()
+    if db.journal:
+        print(f"⚠️ В журнале осталось записей: {len(db.journal)}")
+    write_metrics_snapshot()
+    for session in peer_sessions.values():
+        await session.close()
+    if 'peer_runner' in app:
+        await app['peer_runner'].cleanup()
+    
+    # Вебхук не снимаем: при перевыкатке его сразу подхватывает новый инстанс
     await bot.session.close()
+    print("✅ Дренаж завершён")
 
-if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    # Если есть БД:
-    if DATABASE_URL:
-        loop.run_until_complete(db.connect())
-
+def create_app() -> web.Application:
     app = web.Application()
     app['bot'] = bot
 
-    # Регистрируем webhook
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path="/")
+    # Регистрируем webhook: быстрый ответ, обработка через очередь
+    app.router.add_post("/", handle_webhook)
+    app.router.add_get("/", handle_status)
     setup_application(app, dp)
 
     # Добавляем хук запуска и завершения
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
+    return app
+
+def run_worker(index: int, reuse_port: bool = False):
+    global WORKER_INDEX
+    WORKER_INDEX = index
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Подключение к БД идёт в db.health_loop параллельно с запуском приложения
+    if WEB_WORKERS > 1:
+        if DATABASE_URL:
+            # Пока база недоступна, SharedState сам держит состояние в памяти процесса
+            shared_state.use(PostgresStateBackend(db))
+        else:
+            print(f"⚠️ Worker {index}: нет БД, состояние останется локальным для процесса")
 
     port = int(os.environ.get("PORT", 5000))
-    web.run_app(app, host="0.0.0.0", port=port)
+    web.run_app(create_app(), host="0.0.0.0", port=port, reuse_port=reuse_port, loop=loop)
+
+def run_supervisor(workers: int):
+    # Форкаем воркеров, слушающих один порт через SO_REUSEPORT, и перезапускаем упавших.
+    # Ядро раздаёт соединения случайно, поэтому воркер пересылает обновление владельцу
+    # (user_id % WEB_WORKERS) через unix-сокет — порядок обновлений пользователя держит одна очередь
+    children = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(index, reuse_port=True)
+            finally:
+                os._exit(0)
+        children[pid] = index
+        print(f"Worker {index} started (pid {pid})")
+
+    def stop(signum, frame):
+        # Сигнал передаётся воркерам как есть: каждый сам проходит дренаж в on_shutdown
+        nonlocal stopping, stop_deadline
+        if stopping:
+            return
+        stopping = True
+        stop_deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+        print(f"🛑 Супервизор: дренаж воркеров (сигнал {signum})")
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    stop_deadline = None
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        # Воркеры, не уложившиеся в дедлайн дренажа, завершаем принудительно
+        if stopping and time.monotonic() > stop_deadline:
+            for pid in list(children):
+                print(f"Worker {children[pid]} (pid {pid}) не завершился вовремя, SIGKILL")
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(pid, signal.SIGKILL)
+            stop_deadline = float('inf')
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        print(f"Worker {index} (pid {pid}) exited with status {status}")
+        if not stopping:
+            time.sleep(1)
+            if not stopping:
+                spawn(index)
+
+if __name__ == "__main__":
+    if WEB_WORKERS > 1:
+        run_supervisor(WEB_WORKERS)
+    else:
+        run_worker(0)
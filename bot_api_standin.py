@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+ЗАГЛУШКА BOT API ДЛЯ ПРОВЕРКИ ЛОКАЛЬНОГО РЕЖИМА
+Отвечает на методы, которые вызывает бот, и показывает, как пришёл файл: путём (file://) или multipart загрузкой
+
+Запуск:
+    python bot_api_standin.py --local --webhook http://127.0.0.1:5000/
+    TELEGRAM_API_URL=http://127.0.0.1:8081 RENDER_EXTERNAL_HOSTNAME=localhost python FULL_MUSIC_BOT.py
+    curl -d 'text=https://soundcloud.com/...' http://127.0.0.1:8081/_standin/update
+"""
+
+import argparse
+import itertools
+import os
+import time
+from urllib.parse import unquote, urlparse
+
+from aiohttp import ClientSession, web
+
+LOCAL_UPLOAD_LIMIT = 2000 * 1024 * 1024
+REMOTE_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+message_ids = itertools.count(1)
+update_ids = itertools.count(1)
+
+def ok(result):
+    return web.json_response({"ok": True, "result": result})
+
+def error(code: int, description: str):
+    return web.json_response({"ok": False, "error_code": code, "description": description}, status=code)
+
+def fake_message(chat_id, **extra) -> dict:
+    return {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id or 1), "type": "private"},
+        **extra,
+    }
+
+async def read_upload(form, field: str, local: bool):
+    """Размер файла и способ доставки или (None, текст ошибки)"""
+    value = form.get(field)
+    if isinstance(value, str) and value.startswith('attach://'):
+        value = form.get(value[len('attach://'):])
+    if isinstance(value, web.FileField):
+        return len(value.file.read()), "multipart"
+    if isinstance(value, str) and value.startswith('file://'):
+        if not local:
+            return None, "Bad Request: file:// is only supported by a local Bot API server"
+        path = unquote(urlparse(value).path)
+        if not os.path.exists(path):
+            return None, f"Bad Request: file not found: {path}"
+        return os.path.getsize(path), "local path"
+    return 0, "file_id"
+
+def create_app(local: bool, webhook: str) -> web.Application:
+    state = {"webhook": webhook or "", "uploads": []}
+
+    async def handle_method(request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        form = await request.post()
+        chat_id = form.get('chat_id')
+
+        if method == 'getme':
+            return ok({"id": 1, "is_bot": True, "first_name": "Standin", "username": "standin_bot"})
+        if method == 'getwebhookinfo':
+            return ok({"url": state["webhook"], "has_custom_certificate": False, "pending_update_count": 0})
+        if method == 'setwebhook':
+            # Адрес из --webhook важнее: бот просит https://RENDER_EXTERNAL_HOSTNAME/, локально его нет
+            state["webhook"] = webhook or form.get('url', '')
+            return ok(True)
+
+        if method in ('sendaudio', 'senddocument'):
+            field = 'audio' if method == 'sendaudio' else 'document'
+            size, mode = await read_upload(form, field, local)
+            if size is None:
+                return error(400, mode)
+            limit = LOCAL_UPLOAD_LIMIT if local else REMOTE_UPLOAD_LIMIT
+            print(f"📤 {method}: {size / 1024 ** 2:.1f} MB ({mode})")
+            state["uploads"].append({"method": method, "size": size, "mode": mode})
+            if size > limit:
+                return error(413, "Request Entity Too Large")
+            media = {"file_id": f"standin-{len(state['uploads'])}", "file_unique_id": f"u{len(state['uploads'])}"}
+            if field == 'audio':
+                return ok(fake_message(chat_id, audio={**media, "duration": 0}))
+            return ok(fake_message(chat_id, document=media))
+
+        if method.startswith('send') or method.startswith('edit'):
+            print(f"💬 {method}: {(form.get('text') or form.get('caption') or '')[:80]}")
+            return ok(fake_message(chat_id, text=form.get('text') or ''))
+        return ok(True)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        # Имитация входящего сообщения: отправляем обновление на вебхук бота
+        form = await request.post()
+        if not state["webhook"]:
+            return web.Response(status=409, text="webhook is not set yet")
+        user_id = int(form.get('user_id', 1))
+        update = {
+            "update_id": next(update_ids),
+            "message": {
+                **fake_message(user_id, text=form.get('text', '/start')),
+                "from": {"id": user_id, "is_bot": False, "first_name": "Standin"},
+            },
+        }
+        async with ClientSession() as session:
+            async with session.post(state["webhook"], json=update) as response:
+                return web.Response(text=f"webhook → {response.status}\n")
+
+    async def handle_uploads(request: web.Request) -> web.Response:
+        return web.json_response(state["uploads"])
+
+    app = web.Application(client_max_size=LOCAL_UPLOAD_LIMIT + 1024 * 1024)
+    app.router.add_post('/_standin/update', handle_update)
+    app.router.add_get('/_standin/uploads', handle_uploads)
+    app.router.add_post('/bot{token}/{method}', handle_method)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--local', action='store_true', help="вести себя как telegram-bot-api --local")
+    parser.add_argument('--webhook', default='', help="куда слать обновления из /_standin/update")
+    args = parser.parse_args()
+    print(f"🧪 Bot API заглушка на :{args.port} ({'local' if args.local else 'remote'} режим)")
+    web.run_app(create_app(args.local, args.webhook), host="127.0.0.1", port=args.port)